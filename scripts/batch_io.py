@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# Shared batch mode for scripts that can process many samples in one run.
+#
+# The samples are processed in a pool of worker processes, and a failure is
+# reported in a per-sample table on stdout rather than raised, so that one bad
+# sample does not abort the rest of the batch. The exit status is 1 if any
+# sample failed.
+
+import sys
+import time
+import multiprocessing
+
+# worker calling function(job) for one (function, sample name, job) task,
+# returning the sample name, the seconds taken and the error, if any
+def run_task(task):
+    function, sample_name, job = task
+    start = time.time()
+    error = None
+    try:
+        function(job)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return sample_name, time.time() - start, error
+
+# call function(job) for every (sample name, job) in a pool of worker processes,
+# writing the report in input order and returning the exit status
+def run_batch(function, jobs, threads, action="Processed", initializer=None, initargs=()):
+    failures = 0
+    print("sample\tstatus\tseconds\terror")
+    tasks = [ (function, sample_name, job) for sample_name, job in jobs ]
+    with multiprocessing.Pool(max(1, min(threads, len(tasks))), initializer=initializer, initargs=initargs) as pool:
+        for sample_name, elapsed, error in pool.imap(run_task, tasks):
+            status = "FAIL" if error else "OK"
+            failures += error is not None
+            print("%s\t%s\t%.2f\t%s" % (sample_name, status, elapsed, error or ""), flush=True)
+
+    print(f"{action} {len(tasks)} samples, {failures} failed", file=sys.stderr)
+    return min(failures, 1)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# Shared reader for per-base depth files, used by the coverage plots and postprocessing.
+#
+# A depth file is either a per-base depth array written by process_gvcf.py
+# --depth-output (.npy), or the text output of bedtools genomecov -d with one
+# "contig <tab> position <tab> depth" line per base. Text files are parsed with
+# vectorized numpy operations on the raw bytes, and the depths are cached in a binary
+# sidecar (<depth file>.npy) that is read instead whenever it is newer than
+# the text file.
+
+import os
+import numpy as np
+
+def sidecar_filename(depth_filename):
+    return depth_filename + ".npy"
+
+# parse the third column of bedtools genomecov -d output
+def parse_depth_text(depth_filename):
+    with open(depth_filename, 'rb') as f:
+        data = np.frombuffer(f.read(), dtype=np.uint8)
+
+    line_ends = np.flatnonzero(data == ord("\n"))
+    if len(data) > 0 and data[-1] != ord("\n"):
+        line_ends = np.append(line_ends, len(data))
+    tabs = np.flatnonzero(data == ord("\t"))
+    if len(tabs) != 2 * len(line_ends) or np.any(tabs[1::2] > line_ends) or np.any(tabs[2::2] < line_ends[:-1]):
+        raise RuntimeError(f"{depth_filename}: expected three tab-separated columns on every line")
+    if len(line_ends) == 0:
+        return np.zeros(0, dtype=int)
+
+    # gather the depth field of every line, right-aligned into a fixed-width matrix of digits
+    starts = tabs[1::2] + 1
+    width = max(1, int(np.max(line_ends - starts)))
+    index = line_ends[:, None] - width + np.arange(width)
+    padding = index < starts[:, None]
+    digits = data[np.maximum(index, 0)].astype(np.int64) - ord("0")
+    digits[padding] = 0
+
+    if width <= 18 and np.all((digits >= 0) & (digits <= 9)) and np.all(line_ends > starts):
+        return digits @ (10 ** np.arange(width - 1, -1, -1, dtype=np.int64))
+
+    # not plain integers, depths written as floats are truncated as int(float(x)) would
+    fields = [ bytes(data[start:end]) for start, end in zip(starts, line_ends) ]
+    return np.array(fields).astype(np.float64).astype(int)
+
+def write_sidecar(depth_filename, coverage):
+    dtype = np.uint32 if len(coverage) == 0 or coverage.min() >= 0 else coverage.dtype
+    tmp_filename = sidecar_filename(depth_filename) + f".{os.getpid()}.tmp"
+    try:
+        with open(tmp_filename, 'wb') as f:
+            np.save(f, coverage.astype(dtype))
+        os.replace(tmp_filename, sidecar_filename(depth_filename))
+    except OSError:
+        # the cache is only an optimization, e.g. the directory may be read-only
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+# read a depth file as an integer numpy array, using or refreshing the sidecar cache
+def read_depth(depth_filename, use_cache=True):
+    if depth_filename.endswith('.npy'):
+        return np.load(depth_filename).astype(int)
+
+    sidecar = sidecar_filename(depth_filename)
+    if use_cache and os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(depth_filename):
+        return np.load(sidecar).astype(int)
+
+    coverage = parse_depth_text(depth_filename)
+    if use_cache:
+        write_sidecar(depth_filename, coverage)
+    return coverage
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# Shared FASTQ input/output for the pipeline's Python read filters.
+#
+# The outputs of these filters are read once, by bwa or kraken2, so they are
+# written with a fast compression level, and the compression is split into
+# independent BGZF blocks that are deflated on a pool of threads. BGZF is
+# plain multi-member gzip, so any gzip reader can consume it. Output paths
+# that don't end in .gz (including '-' for stdout) are written uncompressed.
+#
+# Records are passed around as the raw bytes of their four FASTQ lines, so
+# filters that don't modify reads never format or decode them.
+
+import sys
+import gzip
+import zlib
+import struct
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# bytes of input per BGZF block, as used by htslib
+BGZF_BLOCK_SIZE = 0xff00
+
+# the empty block htslib expects at the end of a BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# deflate one block of data into a complete BGZF member
+def bgzf_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<BBBBIBBHBBHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(payload) + 25)
+    return header + payload + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+# write a BGZF file, compressing blocks on 'threads' threads and writing them in order
+class BgzfWriter:
+
+    def __init__(self, filename, level=1, threads=1):
+        self.out = open(filename, 'wb')
+        self.level = level
+        self.buffer = bytearray()
+        self.pool = ThreadPoolExecutor(threads) if threads > 1 else None
+        self.max_pending = 4 * threads
+        self.pending = collections.deque()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= BGZF_BLOCK_SIZE:
+            self.compress(bytes(self.buffer[:BGZF_BLOCK_SIZE]))
+            del self.buffer[:BGZF_BLOCK_SIZE]
+
+    def compress(self, data):
+        if self.pool is None:
+            self.out.write(bgzf_block(data, self.level))
+            return
+        self.pending.append(self.pool.submit(bgzf_block, data, self.level))
+        while len(self.pending) >= self.max_pending:
+            self.out.write(self.pending.popleft().result())
+
+    def close(self):
+        if len(self.buffer) > 0:
+            self.compress(bytes(self.buffer))
+            self.buffer = bytearray()
+        while len(self.pending) > 0:
+            self.out.write(self.pending.popleft().result())
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.out.write(BGZF_EOF)
+        self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# an uncompressed binary output, where '-' is stdout
+class RawWriter:
+
+    def __init__(self, filename):
+        self.out = sys.stdout.buffer if filename == '-' else open(filename, 'wb')
+
+    def write(self, data):
+        self.out.write(data)
+
+    def close(self):
+        if self.out is sys.stdout.buffer:
+            self.out.flush()
+        else:
+            self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# open a binary output, compressed as BGZF if the filename ends in .gz
+def open_output(filename, level=1, threads=1):
+    if filename.endswith(".gz"):
+        return BgzfWriter(filename, level, threads)
+    return RawWriter(filename)
+
+# open a binary input, gzipped or not, where '-' is stdin
+def open_input(filename):
+    handle = sys.stdin.buffer if filename == '-' else open(filename, 'rb')
+    if handle.peek(2)[:2] == b"\x1f\x8b":
+        return gzip.GzipFile(fileobj=handle)
+    return handle
+
+# bytes read from an input at a time by FastqChunkReader
+CHUNK_READ_SIZE = 1 << 20
+
+# cut a 4-line FASTQ stream into chunks of whole records, as raw bytes. Only the
+# line ends are located here, so the work of splitting and checking the records can
+# be left to split_fastq_records() in worker processes. A missing newline at the end
+# of the input is added
+class FastqChunkReader:
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.buffer = bytearray()
+        self.eof = False
+
+    # the next chunk of up to nrecords records, b"" at the end of the input
+    def read(self, nrecords):
+        end = 0
+        for _ in range(4 * nrecords):
+            newline = self.buffer.find(b"\n", end)
+            while newline < 0 and not self.eof:
+                data = self.handle.read(CHUNK_READ_SIZE)
+                if not data:
+                    self.eof = True
+                    if len(self.buffer) > 0 and not self.buffer.endswith(b"\n"):
+                        self.buffer += b"\n"
+                else:
+                    self.buffer += data
+                newline = self.buffer.find(b"\n", end)
+            if newline < 0:
+                break
+            end = newline + 1
+
+        chunk = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return chunk
+
+# split a chunk from FastqChunkReader into the bytes of each record's four lines,
+# including the final newline, and the sequence line of each record
+def split_fastq_records(chunk):
+    lines = chunk.split(b"\n")[:-1]
+    if len(lines) % 4 != 0:
+        raise ValueError("malformed FASTQ record starting with " + lines[len(lines) - len(lines) % 4].decode(errors='replace'))
+    records = []
+    for i in range(0, len(lines), 4):
+        if not lines[i].startswith(b"@") or not lines[i + 2].startswith(b"+"):
+            raise ValueError("malformed FASTQ record starting with " + lines[i].decode(errors='replace'))
+        records.append(b"\n".join(lines[i:i+4]) + b"\n")
+    return records, lines[1::4]
@@ -2,20 +2,94 @@
 import pysam
 import sys
 import argparse
+from fastq_io import open_output
 
-def filter_reads(contig_name, input_sam_fp, output_bam_fp):
+# used to write reverse strand reads back in their sequenced orientation
+COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+
+# format an alignment as a FASTQ record the same way samtools fastq does
+def fastq_record(read):
+    seq = read.query_sequence
+    qual = pysam.array_to_qualitystring(read.query_qualities)
+    if read.is_reverse:
+        seq = seq.translate(COMPLEMENT)[::-1]
+        qual = qual[::-1]
+
+    name = read.query_name
+    if read.is_read1:
+        name += "/1"
+    elif read.is_read2:
+        name += "/2"
+    return f"@{name}\n{seq}\n+\n{qual}\n".encode('ascii')
+
+# write the kept reads as R1/R2/singleton FASTQ files
+# reads must arrive grouped by name, as they do straight out of bwa mem, so that
+# the keep/drop decisions for both mates are known together: pairs where both
+# mates are kept go to R1/R2, lone kept mates go to the singletons file
+class PairedFastqWriter:
+
+    def __init__(self, r1_fp, r2_fp, singletons_fp, threads=1):
+        self.r1 = open_output(r1_fp, 1, threads)
+        self.r2 = open_output(r2_fp, 1, threads)
+        self.singletons = open_output(singletons_fp, 1, threads)
+        self.name = None
+        self.kept = []
+
+    def add(self, read, keep):
+        if read.query_name != self.name:
+            self.flush()
+            self.name = read.query_name
+        if keep:
+            self.kept.append(read)
+
+    def flush(self):
+        if len(self.kept) == 2 and self.kept[0].is_read1 != self.kept[1].is_read1:
+            r1, r2 = self.kept if self.kept[0].is_read1 else reversed(self.kept)
+            self.r1.write(fastq_record(r1))
+            self.r2.write(fastq_record(r2))
+        else:
+            for read in self.kept:
+                self.singletons.write(fastq_record(read))
+        self.kept = []
+
+    def close(self):
+        self.flush()
+        for f in [ self.r1, self.r2, self.singletons ]:
+            f.close()
+
+def filter_reads(contig_names, input_sam_fp, output_bam_fp, threads=1, uncompressed=False, fastq_fps=None):
 
     # use streams if args are None
+    # the input format (SAM, BAM or uncompressed BAM) is detected by htslib
     if input_sam_fp:
-        input_sam = pysam.AlignmentFile(input_sam_fp, 'r')
+        input_sam = pysam.AlignmentFile(input_sam_fp, 'r', threads=threads)
     else:
-        input_sam = pysam.AlignmentFile('-', 'r')
+        input_sam = pysam.AlignmentFile('-', 'r', threads=threads)
 
+    # uncompressed BAM is intended for piping straight into samtools
+    # the BAM is optional when writing FASTQ, otherwise it goes to stdout by default
+    output_mode = 'wbu' if uncompressed else 'wb'
     if output_bam_fp:
-        output_bam = pysam.AlignmentFile(output_bam_fp, 'wb',
-                                         template=input_sam)
+        output_bam = pysam.AlignmentFile(output_bam_fp, output_mode,
+                                         template=input_sam, threads=threads)
+    elif fastq_fps:
+        output_bam = None
     else:
-        output_bam = pysam.AlignmentFile('-', 'wb', template=input_sam)
+        output_bam = pysam.AlignmentFile('-', output_mode, template=input_sam,
+                                         threads=threads)
+
+    output_fastq = PairedFastqWriter(*fastq_fps, threads=threads) if fastq_fps else None
+
+    # resolve the contig names to reference ids once, rather than comparing
+    # the reference name of every read
+    viral_ids = set()
+    for contig_name in contig_names:
+        tid = input_sam.get_tid(contig_name)
+        if tid < 0:
+            print(f"Warning: contig {contig_name} is not in the input header",
+                  file=sys.stderr)
+        else:
+            viral_ids.add(tid)
 
     # if read isn't mapped or mapped to viral reference contig name
     viral_reads = 0
@@ -26,14 +100,24 @@ def filter_reads(contig_name, input_sam_fp, output_bam_fp):
     for read in input_sam:
         # only look at primary alignments
         if not read.is_supplementary and not read.is_secondary:
-            if read.reference_name == contig_name:
-                output_bam.write(read)
+            keep = True
+            if read.reference_id in viral_ids:
                 viral_reads += 1
             elif read.is_unmapped:
-                output_bam.write(read)
                 unmapped_reads +=1
             else:
                 human_reads += 1
+                keep = False
+
+            if keep and output_bam is not None:
+                output_bam.write(read)
+            if output_fastq is not None:
+                output_fastq.add(read, keep)
+
+    if output_bam is not None:
+        output_bam.close()
+    if output_fastq is not None:
+        output_fastq.close()
 
     total_reads = viral_reads + human_reads + unmapped_reads
 
@@ -54,17 +138,35 @@ if __name__ == '__main__':
                                                   "specific reference "
                                                   "contig")
     parser.add_argument('-i', '--input', required=False, default=False,
-                        help="Input SAM formatted file (stdin used if "
+                        help="Input SAM or BAM formatted file (stdin used if "
                               " not specified)")
 
     parser.add_argument('-o', '--output', required=False, default=False,
                         help="Output BAM formatted file (stdout used if not "
                              "specified)")
 
-    parser.add_argument('-c', '--contig_name', required=False,
-                        default="MN908947.3",
-                        help="Contig name to retain e.g. viral")
+    parser.add_argument('-c', '--contig_name', required=False, nargs='+',
+                        default=["MN908947.3"],
+                        help="Contig name(s) to retain e.g. viral")
+
+    parser.add_argument('-t', '--threads', required=False, type=int,
+                        default=1,
+                        help="Number of threads used for BAM compression "
+                             "and decompression, and for FASTQ compression")
+
+    parser.add_argument('-u', '--uncompressed', required=False,
+                        action='store_true',
+                        help="Write uncompressed BAM, e.g. when piping into "
+                             "samtools")
+
+    parser.add_argument('--fastq', required=False, nargs=3, default=None,
+                        metavar=('R1', 'R2', 'SINGLETONS'),
+                        help="Also write the kept reads as gzipped R1, R2 and "
+                             "singleton FASTQ files, in which case the BAM is "
+                             "only written if -o is given. The input must be "
+                             "grouped by read name, as bwa mem output is")
 
     args = parser.parse_args()
 
-    filter_reads(args.contig_name, args.input, args.output)
+    filter_reads(args.contig_name, args.input, args.output, args.threads,
+                 args.uncompressed, args.fastq)
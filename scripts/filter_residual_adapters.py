@@ -1,86 +1,240 @@
 #!/usr/bin/env python
-import gzip
+import re
 import pysam
 import sys
 import argparse
+import collections
+import multiprocessing
+from fastq_io import open_input, open_output, FastqChunkReader, split_fastq_records
 
 # require that filename contains the specified extension
 def require_extension(filename, ext):
-    assert(args.input_R1[-len(ext):] == ext)
-
-def contains_adapter(read_sequence, adapter_sequence, min_match_length):
-    # discard all reads that contain the full adapter
-    if adapter_sequence in read_sequence:
-        return True
-
-    # discard all reads where the suffix of length min_match_length is contained within the adapter
-    # this handles the case where there is a fairly good adapter match that is truncated
-    # by the end of the read
-    rl = len(read_sequence)
-    if rl >= min_match_length:
-        read_suffix = read_sequence[(rl - min_match_length):]
-        if read_suffix in adapter_sequence:
+    assert(filename[-len(ext):] == ext)
+
+# build a regular expression matching any of the sequences, with shared prefixes
+# factored into a trie so the pattern does not grow linearly with the adapter set
+def trie_pattern(sequences):
+    trie = {}
+    for sequence in sequences:
+        node = trie
+        for c in sequence:
+            node = node.setdefault(c, {})
+        node[''] = {}
+
+    def build(node):
+        # we only need to know whether any sequence matches, so a sequence
+        # that is a prefix of another makes the longer one redundant
+        if '' in node:
+            return ''
+        alternatives = [ re.escape(c) + build(child) for c, child in sorted(node.items()) ]
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return '(?:' + '|'.join(alternatives) + ')'
+
+    return build(trie)
+
+# a read matches if it contains a full adapter, or if its suffix of length
+# min_match_length is contained within an adapter (a fairly good adapter match
+# that is truncated by the end of the read). Precompiled over the whole set of
+# adapters: one regex scan for full matches, and one set lookup for the suffix
+class AdapterMatcher:
+
+    def __init__(self, adapter_sequences, min_match_length):
+        self.min_match_length = min_match_length
+        self.full_match = re.compile(trie_pattern(adapter_sequences)) if adapter_sequences else None
+
+        # every substring of length min_match_length of every adapter
+        k = min_match_length
+        self.adapter_kmers = set(a[i:i+k] for a in adapter_sequences for i in range(len(a) - k + 1))
+
+    def matches(self, read_sequence):
+        if self.full_match is not None and self.full_match.search(read_sequence):
             return True
-    return False
-
-def filter_reads(filter_sequences, min_match_length, input_R1_fp, input_R2_fp, output_R1_fp, output_R2_fp):
+        k = self.min_match_length
+        return len(read_sequence) >= k and read_sequence[-k:] in self.adapter_kmers
+
+    def matches_pair(self, read1_sequence, read2_sequence):
+        return self.matches(read1_sequence) or self.matches(read2_sequence)
+
+# read adapter sequences from a fasta file
+def read_adapters(fasta_filename):
+    return [ record.sequence.upper() for record in pysam.FastxFile(fasta_filename) ]
+
+# per-process matcher used by filter_chunk(), set up once by init_worker()
+worker_matcher = None
+
+def init_worker(filter_sequences, min_match_length):
+    global worker_matcher
+    worker_matcher = AdapterMatcher(filter_sequences, min_match_length)
+
+# yield (R1 chunk, R2 chunk) of batch_size read pairs from a pair of FASTQ files.
+# The chunks are raw bytes cut at record boundaries, and the records are only
+# split in filter_chunk(), so that the reader has little to do per read
+def read_paired_chunks(input_R1, input_R2, batch_size):
+    reader_R1 = FastqChunkReader(input_R1)
+    reader_R2 = FastqChunkReader(input_R2)
+    while True:
+        chunk_R1 = reader_R1.read(batch_size)
+        chunk_R2 = reader_R2.read(batch_size) if chunk_R1 else b""
+        if not chunk_R1 or not chunk_R2:
+            return
+        yield chunk_R1, chunk_R2
+
+# yield (chunk, None) of batch_size read pairs from an interleaved FASTQ stream
+def read_interleaved_chunks(input_fastq, batch_size):
+    reader = FastqChunkReader(input_fastq)
+    while True:
+        chunk = reader.read(2 * batch_size)
+        if not chunk:
+            return
+        yield chunk, None
+
+# apply the adapter test to the read pairs of a chunk, returning the kept
+# R1 and R2 records as bytes along with the kept/filtered counts.
+# When interleaved, all the kept records are returned in the first field
+def filter_chunk(chunk_R1, chunk_R2, interleaved=False):
+    records_R1, sequences_R1 = split_fastq_records(chunk_R1)
+    if chunk_R2 is None:
+        if len(records_R1) % 2 != 0:
+            raise ValueError("interleaved input has an odd number of records")
+        records_R1, records_R2 = records_R1[0::2], records_R1[1::2]
+        sequences_R1, sequences_R2 = sequences_R1[0::2], sequences_R1[1::2]
+    else:
+        records_R2, sequences_R2 = split_fastq_records(chunk_R2)
+
+    kept_R1 = []
+    kept_R2 = []
+    npairs = min(len(records_R1), len(records_R2))
+    for i in range(npairs):
+        if worker_matcher.matches_pair(sequences_R1[i].decode('ascii'), sequences_R2[i].decode('ascii')):
+            continue
+        kept_R1.append(records_R1[i])
+        (kept_R1 if interleaved else kept_R2).append(records_R2[i])
 
-    input_R1 = pysam.FastxFile(input_R1_fp)
-    input_R2 = pysam.FastxFile(input_R2_fp)
+    reads_kept = (len(kept_R1) + len(kept_R2)) // 2
+    return b"".join(kept_R1), b"".join(kept_R2), reads_kept, npairs - reads_kept
 
-    output_R1 = gzip.open(output_R1_fp, 'w')
-    output_R2 = gzip.open(output_R2_fp, 'w')
+# filter the chunks of read pairs, writing kept pairs to output_R1 and output_R2,
+# or interleaved to output_R1 if output_R2 is None. With threads > 1, the chunks
+# are filtered by a pool of 'threads' worker processes
+def filter_reads(filter_sequences, min_match_length, chunks, output_R1, output_R2, threads=1, log=sys.stdout):
 
+    interleaved = output_R2 is None
     reads_filtered = 0
     reads_kept = 0
-    for R1, R2 in zip(input_R1, input_R2):
 
-        discard = False
-        for f in filter_sequences:
-            if contains_adapter(R1.sequence, f, min_match_length) or contains_adapter(R2.sequence, f, min_match_length):
-                discard = True
-                break
+    def write_batch(result):
+        nonlocal reads_kept, reads_filtered
+        fq1, fq2, kept, filtered = result
+        output_R1.write(fq1)
+        if not interleaved:
+            output_R2.write(fq2)
+        reads_kept += kept
+        reads_filtered += filtered
+
+    if threads > 1:
+        # the reader hands chunks to the pool, and results are written back in input
+        # order. The number of chunks in flight is bounded so that a fast reader
+        # cannot pull the whole input into memory
+        with multiprocessing.Pool(threads, initializer=init_worker, initargs=(filter_sequences, min_match_length)) as pool:
+            pending = collections.deque()
+            for chunk_R1, chunk_R2 in chunks:
+                pending.append(pool.apply_async(filter_chunk, (chunk_R1, chunk_R2, interleaved)))
+                if len(pending) >= 2 * threads:
+                    write_batch(pending.popleft().get())
+            while len(pending) > 0:
+                write_batch(pending.popleft().get())
+    else:
+        init_worker(filter_sequences, min_match_length)
+        for chunk_R1, chunk_R2 in chunks:
+            write_batch(filter_chunk(chunk_R1, chunk_R2, interleaved))
+
+    output_R1.close()
+    if not interleaved:
+        output_R2.close()
+
+    print(f"reads kept: {reads_kept}, reads filtered: {reads_filtered}", file=log)
 
-        if discard:
-            reads_filtered += 1
-            continue
-        else:
-            reads_kept += 1
+if __name__ == '__main__':
 
-            fq1 = str(R1) + "\n"
-            fq2 = str(R2) + "\n"
-            output_R1.write(fq1.encode('utf-8'))
-            output_R2.write(fq2.encode('utf-8'))
+    parser = argparse.ArgumentParser(description="Discard read pairs that contain sequencing adapters that are missed by a trimmer")
+    parser.add_argument('--input_R1', required=False, default=None,
+                        help="Input fastq file for first half of pair")
 
-    print(f"reads kept: {reads_kept}, reads filtered: {reads_filtered}")
+    parser.add_argument('--input_R2', required=False, default=None,
+                        help="Input fastq file for second half of pair")
 
-if __name__ == '__main__':
+    parser.add_argument('--interleaved', required=False, action='store_true',
+                        help="Write the kept pairs as uncompressed interleaved fastq to stdout, e.g. for bwa mem -p. "
+                             "Interleaved fastq is read from stdin unless --input_R1 and --input_R2 are given")
 
-    parser = argparse.ArgumentParser(description="Discard read pairs that contain sequencing adapters that are missed by a trimmer")
-    parser.add_argument('--input_R1', required=True, default=False,
-                        help="Input fasta/fastq file for first half of pair")
+    parser.add_argument('--adapters', required=False, default=None,
+                        help="Fasta file of adapter sequences to filter (default: Illumina S7 and P7)")
 
-    parser.add_argument('--input_R2', required=True, default=False,
-                        help="Input fasta/fastq file for second half of pair")
+    parser.add_argument('--min_match_length', required=False, type=int, default=10,
+                        help="Minimum match between the end of a read and an adapter")
 
-    args = parser.parse_args()
+    parser.add_argument('--threads', required=False, type=int, default=1,
+                        help="Total number of threads, shared between the reader, the worker processes "
+                             "applying the adapter test and the output compression")
+
+    parser.add_argument('--compression_threads', required=False, type=int, default=None,
+                        help="Number of threads compressing each of the two outputs, taken out of "
+                             "--threads (default: max(1, threads // 8))")
 
-    # this is designed to only work in the nextflow pipeline so we put strict requirements on the input/output names
-    in_ext = ".fq.gz"
-    require_extension(args.input_R1, in_ext)
-    require_extension(args.input_R2, in_ext)
+    parser.add_argument('--batch_size', required=False, type=int, default=10000,
+                        help="Number of read pairs handed to a worker at a time")
+
+    parser.add_argument('--compression_level', required=False, type=int, default=1,
+                        help="gzip compression level of the outputs")
+
+    args = parser.parse_args()
 
-    out_ext = "_posttrim_filter.fq.gz"
-    output_R1 = args.input_R1.replace(in_ext, out_ext)
-    output_R2 = args.input_R2.replace(in_ext, out_ext)
+    # the workers do most of the work, so the outputs only get a share of the thread budget.
+    # A single compression thread is the reader's own, otherwise each output has its own pool
+    compression_threads = args.compression_threads or max(1, args.threads // 8)
+    if args.interleaved or compression_threads == 1:
+        workers = args.threads - 1
+    else:
+        workers = args.threads - 1 - 2 * compression_threads
+    workers = max(1, workers)
+
+    if args.interleaved:
+        # stdout carries the reads, so the summary goes to stderr
+        log = sys.stderr
+        output_R1 = open_output('-')
+        output_R2 = None
+    else:
+        if not args.input_R1 or not args.input_R2:
+            parser.error("--input_R1 and --input_R2 are required unless --interleaved is given")
+
+        # this is designed to only work in the nextflow pipeline so we put strict requirements on the input/output names
+        in_ext = ".fq.gz"
+        require_extension(args.input_R1, in_ext)
+        require_extension(args.input_R2, in_ext)
+
+        out_ext = "_posttrim_filter.fq.gz"
+        log = sys.stdout
+        output_R1 = open_output(args.input_R1.replace(in_ext, out_ext), args.compression_level, compression_threads)
+        output_R2 = open_output(args.input_R2.replace(in_ext, out_ext), args.compression_level, compression_threads)
+
+    if args.input_R1 or args.input_R2:
+        if not args.input_R1 or not args.input_R2:
+            parser.error("--input_R1 and --input_R2 must be given together")
+        chunks = read_paired_chunks(open_input(args.input_R1), open_input(args.input_R2), args.batch_size)
+    else:
+        chunks = read_interleaved_chunks(open_input('-'), args.batch_size)
 
     # Illumina adapters that are occasionally leftover in reads
     S7 = "CCGAGCCCACGAGAC"
     P7 = "ATCTCGTATGCCGTCTTCTGCTTG"
 
     # require a minimum match between read and adapter
-    min_length = 10
-    filter_sequences = [ S7, P7 ]
+    min_length = args.min_match_length
+    if args.adapters:
+        filter_sequences = read_adapters(args.adapters)
+    else:
+        filter_sequences = [ S7, P7 ]
 
-    filter_reads(filter_sequences, min_length, args.input_R1, args.input_R2, output_R1, output_R2)
+    filter_reads(filter_sequences, min_length, chunks, output_R1, output_R2, workers, log)
 
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# Run freebayes over amplicon-aligned regions of the reference concurrently and
+# merge the per-region gVCFs back into a single coordinate-ordered gVCF on stdout
+
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+import pysam
+from concurrent.futures import ThreadPoolExecutor
+
+# read (name, sequence) for every contig in the reference fasta
+def read_contigs(reference_filename):
+    return [ (record.name, record.sequence) for record in pysam.FastxFile(reference_filename) ]
+
+# read the amplicon bed file into a dict of contig -> sorted list of (start, end)
+def read_amplicons(bed_filename):
+    amplicons = dict()
+    for line in open(bed_filename):
+        t = line.rstrip('\n').split('\t')
+        if len(t) < 3 or line.startswith(('#', 'track', 'browser')):
+            continue
+        amplicons.setdefault(t[0], list()).append((int(t[1]), int(t[2])))
+    for intervals in amplicons.values():
+        intervals.sort()
+    return amplicons
+
+# split every contig into about nshards 0-based, half-open (contig, start, end) regions.
+# When amplicons are known the boundaries are placed midway between the end of one
+# amplicon and the start of the next, so every region is made of whole amplicons
+def make_regions(contigs, amplicons, nshards):
+    total_length = sum(len(sequence) for _, sequence in contigs)
+    regions = list()
+    for name, sequence in contigs:
+        length = len(sequence)
+        n = max(1, round(nshards * length / total_length))
+
+        intervals = amplicons.get(name, [])
+        if len(intervals) > 1:
+            candidates = [ (intervals[i][1] + intervals[i + 1][0]) // 2 for i in range(len(intervals) - 1) ]
+            n = min(n, len(candidates) + 1)
+            boundaries = [ candidates[(k * len(candidates)) // n] for k in range(1, n) ]
+        else:
+            boundaries = [ (k * length) // n for k in range(1, n) ]
+
+        edges = [ 0 ] + sorted(set(b for b in boundaries if 0 < b < length)) + [ length ]
+        for start, end in zip(edges[:-1], edges[1:]):
+            regions.append((name, start, end))
+    return regions
+
+# run one freebayes process per region, at most 'threads' at a time
+def run_shards(freebayes_args, reference_filename, bam_filename, regions, workdir, threads):
+    def run(i):
+        contig, start, end = regions[i]
+        shard_filename = os.path.join(workdir, "shard_%04d.gvcf" % (i))
+        with open(shard_filename, 'w') as out:
+            command = [ "freebayes", "-f", reference_filename ] + freebayes_args + [ "--region", f"{contig}:{start}-{end}", bam_filename ]
+            subprocess.run(command, stdout=out, check=True)
+        return shard_filename
+
+    with ThreadPoolExecutor(threads) as pool:
+        return list(pool.map(run, range(len(regions))))
+
+# the last reference position (1-based, inclusive) covered by a gVCF record
+def record_end(fields):
+    for kv in fields[7].split(';'):
+        if kv.startswith("END="):
+            return int(kv[4:])
+    return int(fields[1]) + len(fields[3]) - 1
+
+def set_record_end(fields, end):
+    fields[7] = ';'.join(f"END={end}" if kv.startswith("END=") else kv for kv in fields[7].split(';'))
+
+# concatenate the shard gVCFs in region order. Each shard only contributes the positions
+# inside its own region: reference blocks that run over a region boundary, or over a
+# variant already emitted by the previous shard, are clipped, and anything else outside
+# the region is dropped
+def merge_gvcf_shards(shard_filenames, regions, contigs, out):
+    sequences = dict(contigs)
+    last_contig = None
+    last_end = 0
+
+    for i, (shard_filename, (contig, start, end)) in enumerate(zip(shard_filenames, regions)):
+        if contig != last_contig:
+            last_contig = contig
+            last_end = 0
+
+        for line in open(shard_filename):
+            if line.startswith('#'):
+                if i == 0:
+                    out.write(line)
+                continue
+
+            fields = line.rstrip('\n').split('\t')
+            assert(fields[0] == contig)
+            is_gvcf_ref = fields[4] == "<*>"
+            v_start = int(fields[1])
+            v_end = record_end(fields)
+
+            # already covered by the previous shard, or belongs to the next one
+            first_owned = max(start, last_end) + 1
+            if v_end < first_owned or v_start > end:
+                continue
+
+            if v_start < first_owned:
+                if not is_gvcf_ref:
+                    continue
+                v_start = first_owned
+                fields[1] = str(v_start)
+                fields[3] = sequences[contig][v_start - 1]
+
+            if is_gvcf_ref and v_end > end:
+                v_end = end
+                set_record_end(fields, v_end)
+
+            out.write('\t'.join(fields) + '\n')
+            last_end = max(last_end, v_end)
+
+def main():
+
+    description = 'Run freebayes in parallel over amplicon-aligned regions and write the merged gVCF to stdout'
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-f', '--reference', required=True,
+            help=f"The reference genome fasta\n")
+
+    parser.add_argument('-b', '--amplicon-bed', default=None,
+            help=f"Bed file of amplicon locations used to place region boundaries (default: equal-sized regions)\n")
+
+    parser.add_argument('-t', '--threads', type=int, default=1,
+            help=f"Number of freebayes processes to run at once\n")
+
+    parser.add_argument('-n', '--shards', type=int, default=None,
+            help=f"Number of regions to split the reference into (default: --threads)\n")
+
+    parser.add_argument('-w', '--workdir', default=None,
+            help=f"Directory in which a temporary directory for the per-region gVCF files is made, and removed once they are merged (default: the system temporary directory)\n")
+
+    parser.add_argument('bam', help=f"The input bam file")
+
+    parser.add_argument('freebayes_args', nargs=argparse.REMAINDER,
+            help=f"Options passed to every freebayes process, after a '--'")
+
+    args = parser.parse_args()
+    freebayes_args = args.freebayes_args
+    if len(freebayes_args) > 0 and freebayes_args[0] == "--":
+        freebayes_args = freebayes_args[1:]
+
+    contigs = read_contigs(args.reference)
+    amplicons = read_amplicons(args.amplicon_bed) if args.amplicon_bed else dict()
+    regions = make_regions(contigs, amplicons, args.shards or args.threads)
+
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+
+    # the per-region gVCFs are only an intermediate, don't leave them behind
+    with tempfile.TemporaryDirectory(prefix="freebayes_shards.", dir=args.workdir) as shard_dir:
+        shard_filenames = run_shards(freebayes_args, args.reference, args.bam, regions, shard_dir, args.threads)
+        merge_gvcf_shards(shard_filenames, regions, contigs, sys.stdout)
+
+if __name__ == "__main__":
+    main()
@@ -2,30 +2,32 @@
 
 import sys
 import os
+import json
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
+from depth_io import read_depth
+from batch_io import run_batch
 
-def write_coverage_plot(depth_file, coverage_plot_name):
-        if not os.path.exists(depth_file):
-            return
+# plots are only ever written to files, so avoid loading an interactive backend
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
 
-        coverage = []
-        for line in open(depth_file):
-            t = line.split('\t')
-            assert len(t) == 3
-            coverage.append(int(float(t[2].strip("\n"))))
+chunk_size = 2500
 
-        coverage = np.array(coverage)
-        assert np.all(coverage >= 0)
+# figures by genome length, so that a worker plotting many samples builds the
+# subplots, log-scale axes and depth guides once and only redraws the coverage
+figure_cache = dict()
 
-        n = len(coverage)
-        assert n >= 1
+def get_coverage_figure(n):
+        if n in figure_cache:
+            return figure_cache[n]
 
-        chunk_size = 2500
         nchunks = (n + chunk_size -1) // chunk_size
 
         kwds = {'wspace':0, 'hspace':0.2, 'bottom':0.02, 'top':0.98 }
-        fig, axarr = plt.subplots(nchunks, 1, sharex=True, gridspec_kw=kwds)
+        fig, axarr = plt.subplots(nchunks, 1, sharex=True, squeeze=False, gridspec_kw=kwds)
+        axarr = axarr[:, 0]
 
         fig.set_figwidth(8)
         fig.set_figheight(0.75 * nchunks)
@@ -33,21 +35,139 @@ def write_coverage_plot(depth_file, coverage_plot_name):
         for i, ax in enumerate(axarr):
             lo = i*chunk_size
             hi = min(n, (i+1)*chunk_size)
-            label = f'{lo}-{hi}'
-
-            ax.fill_between(np.arange(hi-lo), coverage[lo:hi] + 0.1, 1)
-            for level in [ 1.0e1, 1.0e2, 1.0e3]:
-                ax.plot([0,hi-lo], [level,level], ls=':', color='black')
+            ax.hlines([ 1.0e1, 1.0e2, 1.0e3], 0, hi-lo, linestyles=':', colors='black')
 
             ax.set_yscale('log')
             ax.set_ylim(1.0, 3.0e4)
-            ax.text(0.01, 0.95, label, verticalalignment='top', transform=ax.transAxes, color='red')
+
+        figure_cache[n] = (fig, axarr)
+        return figure_cache[n]
+
+# per-bin min, max and mean of the coverage over bins starting at bin_starts
+def bin_coverage(coverage, bin_starts):
+        counts = np.diff(np.append(bin_starts, len(coverage)))
+        return (np.minimum.reduceat(coverage, bin_starts),
+                np.maximum.reduceat(coverage, bin_starts),
+                np.add.reduceat(coverage, bin_starts) / counts)
+
+# the first position of every bin when the rows of the plot are reduced to
+# at most one bin per pixel
+def pixel_bin_starts(n, axarr, dpi):
+        starts = []
+        for i, ax in enumerate(axarr):
+            lo = i*chunk_size
+            hi = min(n, (i+1)*chunk_size)
+            pixels = int(np.ceil(ax.get_position().width * ax.figure.get_figwidth() * dpi))
+            nbins = max(1, min(hi - lo, pixels))
+            starts.append(lo + (np.arange(nbins) * (hi - lo)) // nbins)
+        return starts
+
+# write min/max/mean coverage at bin sizes 1, 4, 16, ... as .npz or .json, for
+# viewers that zoom into the same log-scale panels as the plot
+def write_coverage_track(coverage, track_name):
+        n = len(coverage)
+        track = { 'length': n, 'chunk_size': chunk_size, 'yscale': 'log', 'ylim': [ 1.0, 3.0e4 ], 'bin_sizes': [] }
+        bin_size = 1
+        while True:
+            mins, maxs, means = bin_coverage(coverage, np.arange(0, n, bin_size))
+            track['bin_sizes'].append(bin_size)
+            track[f'min_{bin_size}'] = mins
+            track[f'max_{bin_size}'] = maxs
+            track[f'mean_{bin_size}'] = np.round(means, 2)
+            if len(mins) <= 256:
+                break
+            bin_size *= 4
+
+        if track_name.endswith('.json'):
+            with open(track_name, 'w') as f:
+                json.dump({ k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in track.items() }, f)
+        else:
+            np.savez_compressed(track_name, **track)
+
+def write_coverage_plot(depth_file, coverage_plot_name, full_resolution=False, track_format=None):
+        if not os.path.exists(depth_file):
+            return
+
+        coverage = read_depth(depth_file)
+        assert np.all(coverage >= 0)
+
+        n = len(coverage)
+        assert n >= 1
+
+        fig, axarr = get_coverage_figure(n)
+
+        if not full_resolution:
+            # reduce every row to one bin per pixel, drawn as a step at the bin maximum,
+            # so a pixel is filled up to the highest depth it covers as before
+            row_bin_starts = pixel_bin_starts(n, axarr, fig.dpi)
+            _, maxs, _ = bin_coverage(coverage, np.concatenate(row_bin_starts))
+            row_maxs = np.split(maxs, np.cumsum([ len(b) for b in row_bin_starts ])[:-1])
+
+        # the per-sample artists, removed again once the figure is saved
+        artists = []
+        for i, ax in enumerate(axarr):
+            lo = i*chunk_size
+            hi = min(n, (i+1)*chunk_size)
+            label = f'{lo}-{hi}'
+
+            if full_resolution:
+                x = np.arange(hi-lo)
+                y = coverage[lo:hi]
+            else:
+                x = np.append(row_bin_starts[i] - lo, hi - lo)
+                y = np.append(row_maxs[i], row_maxs[i][-1])
+
+            # the colour is fixed so that it doesn't advance along the cycle with every sample
+            artists.append(ax.fill_between(x, y + 0.1, 1, step=None if full_resolution else 'post', facecolor='C0'))
+            artists.append(ax.text(0.01, 0.95, label, verticalalignment='top', transform=ax.transAxes, color='red'))
 
         print(f"Writing {coverage_plot_name}")
-        plt.savefig(coverage_plot_name)
-        plt.clf()
+        fig.savefig(coverage_plot_name)
+
+        for artist in artists:
+            artist.remove()
+
+        if track_format:
+            write_coverage_track(coverage, os.path.splitext(coverage_plot_name)[0] + "." + track_format)
+
+# a sample without a depth file is skipped in single-sample mode, but reported
+# as a failure when plotting a whole run
+def write_coverage_plot_job(job):
+        depth_file = job[0]
+        if not os.path.exists(depth_file):
+            raise FileNotFoundError(f"depth file {depth_file} does not exist")
+        write_coverage_plot(*job)
+
+# plot every (depth file, plot file) pair in a pool of worker processes,
+# reporting each sample by its depth file and returning the exit status
+def write_coverage_plots(depth_files, coverage_plot_names, threads, full_resolution=False, track_format=None):
+        jobs = [ (d, (d, p, full_resolution, track_format)) for d, p in zip(depth_files, coverage_plot_names) ]
+        return run_batch(write_coverage_plot_job, jobs, threads, "Plotted")
 
 if __name__ == '__main__':
 
-        write_coverage_plot(sys.argv[1], sys.argv[2])
+        parser = argparse.ArgumentParser(description="Plot the per-base depth of one or many samples")
+        parser.add_argument('depth_file', nargs='?',
+                            help="depth file of a single sample (bedtools genomecov -d output or a .npy array)")
+        parser.add_argument('coverage_plot', nargs='?',
+                            help="output plot for a single sample")
+        parser.add_argument('-d', '--depth-files', nargs='+', default=[],
+                            help="depth files of every sample in a run, plotted in a pool of processes")
+        parser.add_argument('-o', '--coverage-plots', nargs='+', default=[],
+                            help="output plots, one for each of --depth-files")
+        parser.add_argument('-t', '--threads', type=int, default=1,
+                            help="number of samples to plot at once")
+        parser.add_argument('--full-resolution', action='store_true',
+                            help="draw every base rather than reducing each row to one bin per pixel")
+        parser.add_argument('--track-format', choices=['npz', 'json'], default=None,
+                            help="also write a multi-resolution min/max/mean coverage track next to each plot")
+        args = parser.parse_args()
 
+        if args.depth_files or args.coverage_plots:
+            if len(args.depth_files) != len(args.coverage_plots):
+                parser.error("--depth-files and --coverage-plots must have the same number of files")
+            sys.exit(write_coverage_plots(args.depth_files, args.coverage_plots, args.threads, args.full_resolution, args.track_format))
+        elif args.depth_file and args.coverage_plot:
+            write_coverage_plot(args.depth_file, args.coverage_plot, args.full_resolution, args.track_format)
+        else:
+            parser.error("either a depth file and a plot name, or --depth-files and --coverage-plots are required")
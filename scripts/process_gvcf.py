@@ -1,64 +1,86 @@
 #!/usr/bin/env python
 # written by @jts from https://github.com/jts/ncov2019-artic-nf/blob/be26baedcc6876a798a599071bb25e0973261861/bin/process_gvcf.py
 
-import itertools
 import argparse
 import pysam
 import sys
 import os
-from collections import defaultdict
-
-# from https://www.geeksforgeeks.org/python-make-a-list-of-intervals-with-sequential-numbers/
-# via artic-mask
-def intervals_extract(iterable):
-    iterable = sorted(set(iterable))
-    for _, group in itertools.groupby(enumerate(iterable), lambda t: t[1] - t[0]):
-        group = list(group)
-        yield [group[0][1], group[-1][1]]
+import csv
+import shutil
+import threading
+import numpy as np
+from batch_io import run_batch
+
+# freebayes declares QR as an Integer but writes floats, patch the header
+# until a release is made with https://github.com/freebayes/freebayes/pull/549
+def copy_patched_gvcf(infh, outfh):
+    for line in infh:
+        if line.startswith(b"##INFO=<ID=QR,"):
+            line = line.replace(b"QR,Number=1,Type=Integer", b"QR,Number=1,Type=Float")
+        outfh.write(line)
+        if line.startswith(b"#CHROM"):
+            break
+
+    # the header is done, pass the records through untouched
+    shutil.copyfileobj(infh, outfh)
+    outfh.close()
+
+# open a gVCF file, or stdin if filename is "-", with the freebayes
+# header fixed on the fly through a pipe so no patched copy is written to disk
+def open_gvcf(filename):
+    infh = sys.stdin.buffer if filename == "-" else open(filename, 'rb')
+    read_fd, write_fd = os.pipe()
+    feeder = threading.Thread(target=copy_patched_gvcf, args=(infh, os.fdopen(write_fd, 'wb')), daemon=True)
+    feeder.start()
+    return pysam.VariantFile(os.fdopen(read_fd, 'r'))
+
+# write a set of records to a bgzipped VCF and index it with tabix
+def write_indexed_vcf(out_filename, header, records):
+    out = pysam.VariantFile(out_filename, 'wz', header=header)
+    for r in records:
+        out.write(r)
+    out.close()
+    pysam.tabix_index(out_filename, preset="vcf", force=True)
+
+# find the runs of consecutive positions where depth < min_coverage, returned as
+# 0-based inclusive (start, end) pairs to be consistent with artic-mask
+def low_depth_intervals(depths, min_coverage):
+    # pad the boolean mask with False on both sides so that every run has
+    # a rising edge and a falling edge in the diff
+    failing = np.concatenate(([False], depths < min_coverage, [False]))
+    edges = np.flatnonzero(np.diff(failing.view(np.int8)))
+    return edges[0::2], edges[1::2] - 1
 
 # write the depth mask used with bcftools to turn consensus positions into Ns
 def write_depth_mask(out_filename, contig_depths, min_coverage):
     maskfh = open(out_filename, 'w')
     for contig_name, depths in contig_depths.items():
-        # from artic-mask, create list of positions that fail the depth check
-        mask_vector = []
-        for pos, depth in enumerate(depths):
-            if depth < min_coverage:
-                mask_vector.append(pos)
-
-        # get the intervals from the mask_vector
-        intervals = list(intervals_extract(mask_vector))
-
-        for i in intervals:
-            maskfh.write("%s\t%s\t%s\n" % (contig_name, i[0]+1, i[1]+1))
+        starts, ends = low_depth_intervals(depths, min_coverage)
+        for start, end in zip(starts, ends):
+            maskfh.write("%s\t%d\t%d\n" % (contig_name, start + 1, end + 1))
     maskfh.close()
 
 # calculate the variant allele fraction for each alt allele using freebayes' read/alt observation tags
-def calculate_vafs(record):
-    vafs = list()
-    total_depth = float(record.info["DP"])
-    for i in range(0, len(record.alts)):
-        alt_reads = int(record.info["AO"][i])
-        vaf = float(alt_reads) / float(record.info["DP"])
-        vafs.append(vaf)
-    return vafs
+def calculate_vafs(depth, alt_observations):
+    total_depth = float(depth)
+    return [ float(alt_reads) / total_depth for alt_reads in alt_observations ]
 
 # make a simple VCF record with the minimal information needed to make the consensus sequence
-def make_simple_record(vcf_header, parent_record, position, ref, alt, vaf):
+def make_simple_record(vcf_header, chrom, depth, position, ref, alt, vaf):
     r = vcf_header.new_record()
-    r.chrom = parent_record.chrom
+    r.chrom = chrom
     r.pos = position
     r.ref = ref
     r.alts = [ alt ]
-    r.info["DP"] = parent_record.info["DP"]
-    r.info["VAF"] = vaf
+    r.info["DP"] = depth
+    r.info["VAF"] = [ vaf ]
     return r
 
 # process indel variants found by freebayes into a variant that should be
-# applied to the consensus sequence
-def handle_indel(vcf_header, record):
+# applied to the consensus sequence. Candidate sites are returned as plain
+# (position, ref, alt, vaf) tuples, records are only built for accepted sites
+def handle_indel(position, ref, alts, vafs):
     output = list()
-    vafs = calculate_vafs(record)
 
     # special case, if we have evidence for multiple possible indels (eg CTTT -> C, CTTT -> CT)
     # we decide whether to apply an indel based on the summed VAF across all alt alleles, then
@@ -76,84 +98,163 @@ def handle_indel(vcf_header, record):
             max_vaf = value
             max_idx = idx
 
-    r = make_simple_record(vcf_header, record, record.pos, record.ref, record.alts[max_idx], [ max_vaf ])
-    output.append(r)
+    output.append((position, ref, alts[max_idx], max_vaf))
     return output
 
-# return the base with the highest value in vaf_by_base,
-# optionally skipping a character (eg. the reference base)
+BASES = "ACGT"
+BASE_INDEX = { b: i for i, b in enumerate(BASES) }
+
+# return the base with the highest value in vaf_by_base (a list indexed
+# like BASES), optionally skipping a character (eg. the reference base)
 def base_max(vaf_by_base, skip=None):
     max_vaf = 0.0
     max_b = None
-    for b in "ACGT":
-        if b != skip and vaf_by_base[b] > max_vaf:
-            max_vaf = vaf_by_base[b]
+    for b, vaf in zip(BASES, vaf_by_base):
+        if b != skip and vaf > max_vaf:
+            max_vaf = vaf
             max_b = b
     return max_b
 
-def handle_sub(vcf_header, record):
+def handle_sub(position, ref, alts, vafs):
     output = list()
 
     # this code is general enough to handle multi-allelic MNPs
     # and the typical case of a biallelic SNP
-    sub_length = len(record.ref)
-
-    vafs = calculate_vafs(record)
+    sub_length = len(ref)
 
     # calculate the VAF of each base at each position of the MNP
-    base_frequency = list()
-    for i in range(0, sub_length):
-        base_frequency.append({ "A":0.0, "C":0.0, "G":0.0, "T":0.0 })
+    base_frequency = [ [ 0.0 ] * len(BASES) for i in range(0, sub_length) ]
 
-    for alt, vaf in zip(record.alts, vafs):
+    for alt, vaf in zip(alts, vafs):
         assert(len(alt) == sub_length)
         for i,b in enumerate(alt):
-            base_frequency[i][b] += vaf
+            base_frequency[i][BASE_INDEX[b]] += vaf
 
-    # construct output records
+    # construct output sites
     for i in range(0, sub_length):
 
         # choose base with highest frequency, skipping the reference
-        max_b = base_max(base_frequency[i], record.ref[i])
+        max_b = base_max(base_frequency[i], ref[i])
         if max_b is None:
             continue
-        r = make_simple_record(vcf_header, record, record.pos + i, record.ref[i], max_b, base_frequency[i][max_b])
-        output.append(r)
+        output.append((position + i, ref[i], max_b, base_frequency[i][BASE_INDEX[max_b]]))
     return output
 
-def main():
-
-    description = 'Process a .gvcf file to create a file of consensus variants, low-frequency variants and a coverage mask'
-    parser = argparse.ArgumentParser(description=description)
-
-    parser.add_argument('-m', '--mask-output', required=True,
-            help=f"The output file name for the coverage mask\n")
-
-    parser.add_argument('-v', '--variants-output', required=True,
-            help=f"The output file name for variants (non-reference gVCF records)\n")
-
-    parser.add_argument('-c', '--consensus-sites-output', required=True,
-            help=f"The output file name for variants that will be applied to generate the consensus sequence\n")
-
-    parser.add_argument('-d', '--min-depth', type=int, default=10,
-            help=f"Mask reference positions with depth less than this threshold")
-
-    parser.add_argument('-l', '--lower-ambiguity-frequency', type=float, default=0.25,
-            help=f"Variants with frequency less than -l will be discarded")
-
-    parser.add_argument('-u', '--upper-ambiguity-frequency', type=float, default=0.75,
-            help=f"Substitution variants with frequency less than -u will be encoded with IUPAC ambiguity codes")
+# write the per-base depth of every contig, concatenated in header order, as a
+# uint32 .npy array that can be read in place of a bedtools genomecov -d file
+def write_depth_track(out_filename, contig_depths):
+    depths = np.concatenate([ d for d in contig_depths.values() ]).astype(np.uint32)
+    with open(out_filename, 'wb') as fh:
+        np.save(fh, depths)
+
+# IUPAC ambiguity codes for a pair of bases, as applied by bcftools consensus -I
+IUPAC_CODES = { "AG":"R", "CT":"Y", "CG":"S", "AT":"W", "GT":"K", "AC":"M" }
+
+def iupac_code(ref, alt):
+    return IUPAC_CODES["".join(sorted(ref.upper() + alt.upper()))]
+
+# read every sequence in a fasta file into a dict keyed by record name
+def read_reference(filename):
+    return { record.name: record.sequence for record in pysam.FastxFile(filename) }
+
+# left-align and trim a variant against the reference, following the same
+# rules as bcftools norm. pos is 0-based
+def left_normalize(sequence, pos, ref, alt):
+    if ref == alt:
+        return pos, ref, alt
+
+    while True:
+        changed = False
+        if len(ref) > 0 and len(alt) > 0 and ref[-1] == alt[-1]:
+            ref = ref[:-1]
+            alt = alt[:-1]
+            changed = True
+        if (len(ref) == 0 or len(alt) == 0) and pos > 0:
+            pos -= 1
+            ref = sequence[pos] + ref
+            alt = sequence[pos] + alt
+            changed = True
+        if not changed:
+            break
+
+    while len(ref) > 1 and len(alt) > 1 and ref[0] == alt[0]:
+        ref = ref[1:]
+        alt = alt[1:]
+        pos += 1
+    return pos, ref, alt
+
+# apply the consensus sites to a reference sequence, replacing the
+# bcftools norm | bcftools consensus -I | bcftools consensus -m chain.
+# sites is a list of (pos, ref, alt, consensus_tag) with 0-based pos,
+# the mask is a pair of arrays of 0-based inclusive interval starts/ends
+def build_consensus(contig_name, sequence, sites, mask_starts, mask_ends):
+    bases = list(sequence)
+    masked = np.zeros(len(sequence), dtype=bool)
+    for start, end in zip(mask_starts, mask_ends):
+        masked[start:end + 1] = True
+
+    normalized = list()
+    for pos, ref, alt, consensus_tag in sites:
+        pos, ref, alt = left_normalize(sequence, pos, ref, alt)
+        if sequence[pos:pos + len(ref)].upper() != ref.upper():
+            raise RuntimeError(f"{contig_name}:{pos+1}: REF allele {ref} does not match the reference")
+        normalized.append((pos, ref, alt, consensus_tag))
+    normalized.sort()
+
+    # ambiguous sites are substitutions so can be applied in place with IUPAC codes
+    for pos, ref, alt, consensus_tag in normalized:
+        if consensus_tag == "ambiguous":
+            assert(len(ref) == 1 and len(alt) == 1)
+            bases[pos] = iupac_code(ref, alt)
+
+    for i in np.flatnonzero(masked):
+        bases[i] = "N"
+
+    # apply the remaining variants, including indels, in reference coordinates
+    pieces = list()
+    last = 0
+    for pos, ref, alt, consensus_tag in normalized:
+        if consensus_tag != "fixed":
+            continue
+        if pos < last:
+            print(f"Skipping {contig_name}:{pos+1} {ref}>{alt}, overlaps a previous variant", file=sys.stderr)
+            continue
+        if masked[pos:pos + len(ref)].any():
+            continue
 
-    parser.add_argument('file', action='store', nargs=1)
+        # keep the shared anchor base from the working sequence so an IUPAC code
+        # at the anchor of an indel is not overwritten
+        shared = 0
+        while shared < min(len(ref), len(alt)) and ref[shared] == alt[shared]:
+            shared += 1
+        pieces.append("".join(bases[last:pos + shared]))
+        pieces.append(alt[shared:])
+        last = pos + len(ref)
+    pieces.append("".join(bases[last:]))
+    return "".join(pieces)
+
+# write the consensus sequences to a fasta file, with each record named after the sample
+def write_consensus(out_filename, sample_name, reference, contig_sites, contig_depths, min_coverage, line_length=60):
+    fh = open(out_filename, 'w')
+    for contig_name, depths in contig_depths.items():
+        mask_starts, mask_ends = low_depth_intervals(depths, min_coverage)
+        consensus = build_consensus(contig_name, reference[contig_name], contig_sites[contig_name], mask_starts, mask_ends)
+        fh.write(">%s\n" % (sample_name or contig_name))
+        for i in range(0, len(consensus), line_length):
+            fh.write(consensus[i:i + line_length] + "\n")
+    fh.close()
 
-    args = parser.parse_args()
-    vcf = pysam.VariantFile(open(args.file[0],'r'))
+# process a single gVCF, args holds the parsed command line options
+def process_gvcf(args):
+    vcf = open_gvcf(args.file)
 
     # Initalize depth mask to all zeros for all contigs
-    contig_depth = defaultdict(list)
+    contig_depth = dict()
+    contig_sites = dict()
     for r in vcf.header.records:
         if r.type == "CONTIG":
-            contig_depth[r['ID']] = [0] * int(r['length'])
+            contig_depth[r['ID']] = np.zeros(int(r['length']), dtype=np.int64)
+            contig_sites[r['ID']] = list()
 
     out_header = vcf.header
 
@@ -164,11 +265,25 @@ def main():
     # open the output file with the changes to apply to the consensus fasta
     # this includes an additional tag in the VCF file
     out_header.info.add("ConsensusTag", number=1, type='String', description="The type of base to be included in the consensus sequence (IUPAC or Fixed)")
-    consensus_sites_out = pysam.VariantFile(args.consensus_sites_output, 'w', header=out_header)
+    consensus_sites_out = None
+    if args.consensus_sites_output:
+        consensus_sites_out = pysam.VariantFile(args.consensus_sites_output, 'w', header=out_header)
+
+    # consensus sites split by ConsensusTag, written once all records have been seen
+    tagged_sites = { "ambiguous": list(), "fixed": list() }
+    wanted_tags = set()
+    if args.ambiguous_sites_output:
+        wanted_tags.add("ambiguous")
+    if args.fixed_sites_output:
+        wanted_tags.add("fixed")
 
     for record in vcf:
 
-        is_gvcf_ref = record.alts[0] == "<*>"
+        # pull everything we need out of the pysam record once
+        chrom = record.chrom
+        ref = record.ref
+        alts = record.alts
+        is_gvcf_ref = alts[0] == "<*>"
 
         # set depth for this part of the genome
         # this works for both gVCF blocks and regular variants
@@ -177,47 +292,45 @@ def main():
         v_end = record.stop
         depth = record.info["DP"]
 
-        # disallow gvcf records that are longer than a single base
-        assert(not is_gvcf_ref or v_start == v_end)
+        # freebayes reports the minimum depth over a multi-base gVCF reference
+        # block in MIN_DP, use it so no base in the block escapes the mask. This
+        # over-masks long blocks, which is why the pipeline runs freebayes with
+        # --gvcf-dont-use-chunk and only ever sees single-base blocks
+        if is_gvcf_ref and v_end > v_start:
+            depth = record.info.get("MIN_DP", depth)
 
         # update depth mask
-        for i in range(v_start, v_end + 1):
-            assert(i > 0)
-            # VCF coordinates are 1-based, we record the depth vector as 0-based
-            # to be consistent with artic-mask
-            contig_depth[record.chrom][i - 1] = depth
+        # VCF coordinates are 1-based, we record the depth vector as 0-based
+        # to be consistent with artic-mask
+        assert(v_start > 0)
+        contig_depth[chrom][v_start - 1:v_end] = depth
 
         # do nothing else with ref records, or records that don't meet our minimum depth
         if is_gvcf_ref or depth < args.min_depth:
             continue
 
+        vafs = calculate_vafs(depth, record.info["AO"])
+
         # determine if any allele in the variant is an indel
-        has_indel = False
-        for i in range(0, len(record.alts)):
-            has_indel = has_indel or len(record.ref) != len(record.alts[i])
+        has_indel = any(len(ref) != len(alt) for alt in alts)
 
         # process the input variant record to handle multi-allelic variants and MNPs
-        out_records = list()
         if has_indel:
             # indels need to be handle specially as we can't apply ambiguity codes
-            out_records = handle_indel(out_header, record)
+            out_sites = handle_indel(v_start, ref, alts, vafs)
         else:
-            out_records = handle_sub(out_header, record)
+            out_sites = handle_sub(v_start, ref, alts, vafs)
 
         # classify variants using VAF cutoffs for IUPAC ambiguity codes, etc
         accept_variant = False
-        for out_r in out_records:
-
-            # at this point we should have resolved multi-allelic variants
-            assert(len(out_r.alts) == 1)
-
-            vaf = out_r.info["VAF"][0]
-            is_indel = len(out_r.ref) != len(out_r.alts[0])
+        for position, site_ref, site_alt, vaf in out_sites:
 
             # discard low frequency variants
             if vaf < args.lower_ambiguity_frequency:
                 continue
 
+            is_indel = len(site_ref) != len(site_alt)
+
             # Write a tag describing what to do with the variant
             consensus_tag = "None"
 
@@ -229,15 +342,133 @@ def main():
             else:
                 # record ambiguous SNPs in the consensus sequence with IUPAC codes
                 consensus_tag = "ambiguous"
-            out_r.info["ConsensusTag"] = consensus_tag
-            consensus_sites_out.write(out_r)
+            contig_sites[chrom].append((position - 1, site_ref, site_alt, consensus_tag))
             accept_variant = True
 
+            # only sites that made it this far are turned into VCF records
+            if consensus_sites_out is not None or consensus_tag in wanted_tags:
+                out_r = make_simple_record(out_header, chrom, depth, position, site_ref, site_alt, vaf)
+                out_r.info["ConsensusTag"] = consensus_tag
+                if consensus_sites_out is not None:
+                    consensus_sites_out.write(out_r)
+                tagged_sites[consensus_tag].append(out_r)
+
         if accept_variant:
-            record.info["VAF"] = calculate_vafs(record)
+            record.info["VAF"] = vafs
             variants_out.write(record)
 
+    variants_out.close()
+    if consensus_sites_out is not None:
+        consensus_sites_out.close()
+
+    if args.ambiguous_sites_output:
+        write_indexed_vcf(args.ambiguous_sites_output, out_header, tagged_sites["ambiguous"])
+    if args.fixed_sites_output:
+        write_indexed_vcf(args.fixed_sites_output, out_header, tagged_sites["fixed"])
+
     write_depth_mask(args.mask_output, contig_depth, args.min_depth)
 
+    if args.depth_output:
+        write_depth_track(args.depth_output, contig_depth)
+
+    if args.consensus_output:
+        reference = read_reference(args.reference)
+        write_consensus(args.consensus_output, args.sample_name, reference, contig_sites, contig_depth, args.min_depth)
+
+# manifest columns for --batch mode, mapped to the single-sample option each one sets
+MANIFEST_COLUMNS = { "sample": "sample_name",
+                     "gvcf": "file",
+                     "mask": "mask_output",
+                     "variants": "variants_output",
+                     "consensus_sites": "consensus_sites_output",
+                     "ambiguous_sites": "ambiguous_sites_output",
+                     "fixed_sites": "fixed_sites_output",
+                     "consensus": "consensus_output",
+                     "depth": "depth_output" }
+
+# read the --batch manifest into one set of options per sample, sharing the
+# thresholds and reference given on the command line
+def read_manifest(manifest_filename, shared_args):
+    jobs = list()
+    with open(manifest_filename) as fh:
+        for row in csv.DictReader(fh, delimiter='\t'):
+            options = dict(vars(shared_args))
+            for column, option in MANIFEST_COLUMNS.items():
+                options[option] = row.get(column) or None
+            for option in [ "sample_name", "file", "mask_output", "variants_output" ]:
+                if options[option] is None:
+                    raise RuntimeError(f"{manifest_filename}: missing {option} for row {row}")
+            if options["consensus_output"] and not options["reference"]:
+                raise RuntimeError(f"{manifest_filename}: consensus output for {options['sample_name']} requires --reference")
+            jobs.append(argparse.Namespace(**options))
+    return jobs
+
+# process every sample in the manifest in a pool of worker processes
+def process_batch(manifest_filename, shared_args, threads):
+    jobs = [ (options.sample_name, options) for options in read_manifest(manifest_filename, shared_args) ]
+    return run_batch(process_gvcf, jobs, threads)
+
+def main():
+
+    description = 'Process a .gvcf file to create a file of consensus variants, low-frequency variants and a coverage mask'
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-m', '--mask-output',
+            help=f"The output file name for the coverage mask\n")
+
+    parser.add_argument('-v', '--variants-output',
+            help=f"The output file name for variants (non-reference gVCF records)\n")
+
+    parser.add_argument('-c', '--consensus-sites-output',
+            help=f"The output file name for variants that will be applied to generate the consensus sequence\n")
+
+    parser.add_argument('-a', '--ambiguous-sites-output',
+            help=f"The bgzipped, tabix-indexed output file name for consensus sites encoded with IUPAC codes (optional)\n")
+
+    parser.add_argument('-x', '--fixed-sites-output',
+            help=f"The bgzipped, tabix-indexed output file name for all other consensus sites (optional)\n")
+
+    parser.add_argument('-p', '--depth-output',
+            help=f"The output file name for the per-base depth as a uint32 .npy array (optional). "
+                 f"Multi-base gVCF reference blocks are recorded at their MIN_DP\n")
+
+    parser.add_argument('-d', '--min-depth', type=int, default=10,
+            help=f"Mask reference positions with depth less than this threshold")
+
+    parser.add_argument('-l', '--lower-ambiguity-frequency', type=float, default=0.25,
+            help=f"Variants with frequency less than -l will be discarded")
+
+    parser.add_argument('-u', '--upper-ambiguity-frequency', type=float, default=0.75,
+            help=f"Substitution variants with frequency less than -u will be encoded with IUPAC ambiguity codes")
+
+    parser.add_argument('-f', '--reference',
+            help=f"The reference genome fasta, required to write the consensus sequence")
+
+    parser.add_argument('-o', '--consensus-output',
+            help=f"The output file name for the consensus sequence (optional)")
+
+    parser.add_argument('-n', '--sample-name',
+            help=f"The name of the consensus sequence record (default: the contig name)")
+
+    parser.add_argument('file', action='store', nargs='?', default='-',
+            help=f"The input gVCF from freebayes (default: stdin)")
+
+    parser.add_argument('-b', '--batch',
+            help=f"Process every sample in this tab-separated manifest instead of a single gVCF. "
+                 f"Columns: {', '.join(MANIFEST_COLUMNS)} (the last five are optional)")
+
+    parser.add_argument('-t', '--threads', type=int, default=1,
+            help=f"Number of worker processes used in --batch mode")
+
+    args = parser.parse_args()
+    if args.batch:
+        sys.exit(process_batch(args.batch, args, args.threads))
+
+    if not args.mask_output or not args.variants_output:
+        parser.error("--mask-output and --variants-output are required")
+    if args.consensus_output and not args.reference:
+        parser.error("--consensus-output requires --reference")
+    process_gvcf(args)
+
 if __name__ == "__main__":
     main()
@@ -1,12 +1,19 @@
 #!/usr/bin/env python
 # written by @jts from https://github.com/jts/ncov-random-scripts/blob/master/quick_align.py
 
+import os
 import sys
 import csv
 import pysam
 import parasail
 import argparse
+import numpy as np
 import textwrap as tw
+from collections import namedtuple
+from batch_io import run_batch
+
+# a genome read from a multi-FASTA in --batch mode, standing in for a pysam record
+Genome = namedtuple('Genome', ['name', 'sequence'])
 
 def get_sequence(file):
     fasta = pysam.FastxFile(file)
@@ -17,58 +24,289 @@ def get_sequence(file):
         reference = record
     return reference
 
-def get_alignment_parasail(reference_genome, input_genome):
+def get_alignment_parasail(reference_genome, input_genome, reference_profile=None):
     
     # the dna full matrix supports ambiguity codes, although "N"s are not given free mismatches as we might like
     # the alignments appear good enough for our purpose however
+    if reference_profile is not None:
+        # a profile built once for the reference by make_reference_profile(), the reference is then
+        # the first sequence of the alignment so the traceback strings swap places
+        result = parasail.nw_trace_striped_profile_32(reference_profile, input_genome.sequence, 10, 1)
+        traceback = result.traceback
+        return traceback.query, traceback.comp, traceback.ref
+
     result = parasail.nw_trace_striped_32(input_genome.sequence, reference_genome.sequence, 10, 1, parasail.dnafull)
     traceback = result.traceback
 
     return traceback.ref, traceback.comp, traceback.query
 
-def alignment2vcf(reference_name, reference_aligned, query_aligned):
+def make_reference_profile(reference_genome):
+    return parasail.profile_create_32(reference_genome.sequence, parasail.dnafull)
 
-    reference_position = 0
-    query_position = 0
-    
-    print("##fileformat=VCFv4.2")
-    print("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER")
-
-    i = 0
-    n = len(reference_aligned)
-    while i < n:
-        if query_aligned[i] == reference_aligned[i]:
-            reference_position += 1
-            query_position += 1
-            i += 1
+# anchored alignment: exact matches of unique k-mers shared by both genomes are
+# taken as aligned, and only the windows between these anchors are aligned with
+# parasail. Anchors are trimmed back by a margin so that indels next to an anchor
+# are placed by the aligner rather than by the anchor boundary
+ANCHOR_K = 32
+ANCHOR_MARGIN = 16
+
+# map each k-mer occurring exactly once in sequence to its position
+def unique_kmers(sequence, k):
+    positions = dict()
+    for i in range(len(sequence) - k + 1):
+        kmer = sequence[i:i+k]
+        positions[kmer] = -1 if kmer in positions else i
+    return { kmer: i for kmer, i in positions.items() if i >= 0 }
+
+# find a chain of non-overlapping exact matches between query and reference,
+# returned as (query_start, reference_start, length) blocks in order
+def find_anchors(query, reference, k):
+    reference_kmers = unique_kmers(reference, k)
+    candidates = sorted((q, reference_kmers[kmer]) for kmer, q in unique_kmers(query, k).items() if kmer in reference_kmers)
+
+    # longest chain of candidates increasing in both query and reference position
+    tails = []
+    tail_index = []
+    previous = [-1] * len(candidates)
+    for i, (q, r) in enumerate(candidates):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tails[mid] < r:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo > 0:
+            previous[i] = tail_index[lo - 1]
+        if lo == len(tails):
+            tails.append(r)
+            tail_index.append(i)
         else:
-            # new difference found, find the next matching base
-            j = i
-            while j < n and query_aligned[j] != reference_aligned[j]:
-                j += 1
+            tails[lo] = r
+            tail_index[lo] = i
+
+    chain = []
+    i = tail_index[-1] if tail_index else -1
+    while i >= 0:
+        chain.append(candidates[i])
+        i = previous[i]
+    chain.reverse()
+
+    # merge overlapping k-mers on the same diagonal into blocks, dropping
+    # k-mers that overlap the previous block on a different diagonal
+    blocks = []
+    for q, r in chain:
+        if blocks:
+            bq, br, bl = blocks[-1]
+            if q - r == bq - br and q <= bq + bl:
+                blocks[-1] = (bq, br, q + k - bq)
+                continue
+            if q < bq + bl or r < br + bl:
+                continue
+        blocks.append((q, r, k))
+    return blocks
+
+# globally align a window between two anchors
+def align_window(query, reference):
+    if len(query) == 0 or len(reference) == 0:
+        return reference + "-" * len(query), " " * (len(query) + len(reference)), "-" * len(reference) + query
+    traceback = parasail.nw_trace_striped_32(query, reference, 10, 1, parasail.dnafull).traceback
+    return traceback.ref, traceback.comp, traceback.query
+
+# shift every gap to the leftmost position with the same score. A window can start
+# inside a repeat, where the aligner can only place an indel as far left as the window
+# allows, whereas the full alignment puts it at the start of the repeat. A gap moves
+# left one column at a time while the base before it can trade places with its last
+# base, stopping at any other gap
+def left_align_gaps(reference_aligned, comparison_aligned, query_aligned):
+    reference = list(reference_aligned)
+    comparison = list(comparison_aligned)
+    query = list(query_aligned)
+    for gapped, other in [ (query, reference), (reference, query) ]:
+        starts, ends = true_runs(as_array("".join(gapped)) == ord("-"))
+        for i, j in zip(starts.tolist(), ends.tolist()):
+            while i > 0 and gapped[i-1] != "-" and other[i-1] != "-" and other[i-1] == other[j-1]:
+                gapped[j-1], gapped[i-1] = gapped[i-1], "-"
+                comparison[j-1], comparison[i-1] = comparison[i-1], " "
+                i -= 1
+                j -= 1
+    return "".join(reference), "".join(comparison), "".join(query)
+
+def get_alignment_anchored(reference_genome, input_genome, k=ANCHOR_K, margin=ANCHOR_MARGIN):
+    query = input_genome.sequence
+    reference = reference_genome.sequence
+
+    reference_parts = []
+    comparison_parts = []
+    query_parts = []
+
+    q_end = 0
+    r_end = 0
+    for q, r, length in find_anchors(query, reference, k) + [ (len(query) - margin, len(reference) - margin, 2 * margin) ]:
+        # trim the anchor back, discarding it if nothing is left
+        length -= 2 * margin
+        if length < 0:
+            continue
+        q += margin
+        r += margin
+
+        (r_aligned, c_aligned, q_aligned) = align_window(query[q_end:q], reference[r_end:r])
+        reference_parts += [ r_aligned, reference[r:r+length] ]
+        comparison_parts += [ c_aligned, "|" * length ]
+        query_parts += [ q_aligned, query[q:q+length] ]
+        q_end = q + length
+        r_end = r + length
+
+    return left_align_gaps("".join(reference_parts), "".join(comparison_parts), "".join(query_parts))
+
+# genomes of equal length that differ only by isolated substitutions are compared
+# position by position. A shifted indel pair costs at least 25 against 18 for two
+# single-base mismatches, but it can still explain several mismatch runs at once (e.g.
+# a 2-base shift through a repeat), so the ungapped alignment is only used when it is
+# also optimal in a window around every difference, with nearby differences sharing a
+# window. parasail computes the window scores without a traceback. Differences
+# involving N or other ambiguity codes don't count towards the runs
+MAX_SUBSTITUTION_RUN = 1
+OPTIMALITY_MARGIN = 64
+ACGT_CODES = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+def as_array(sequence):
+    return np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)
+
+# 0-based start and end of each run of True values
+def true_runs(mask):
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask.view(np.int8), [0]))))
+    return edges[0::2], edges[1::2]
 
-            # Get difference strings
-            q_sub = query_aligned[i:j]
-            r_sub = reference_aligned[i:j]
+def is_substitution_only(reference_genome, input_genome):
+    if len(reference_genome.sequence) != len(input_genome.sequence):
+        return False
+    r = as_array(reference_genome.sequence.upper())
+    q = as_array(input_genome.sequence.upper())
+    substituted = (r != q) & np.isin(r, ACGT_CODES) & np.isin(q, ACGT_CODES)
+    starts, ends = true_runs(substituted)
+    return np.all(ends - starts <= MAX_SUBSTITUTION_RUN) and np.all(starts[1:] - ends[:-1] >= ANCHOR_K)
 
-            q_gaps = q_sub.count("-")
-            r_gaps = r_sub.count("-")
+# the distinct (query, reference) character pairs of two equal length genomes, and
+# the index of every column's pair, with the pair's single column alignment from parasail
+def ungapped_pairs(reference_genome, input_genome):
+    r = as_array(reference_genome.sequence)
+    q = as_array(input_genome.sequence)
+    pairs, pair_index = np.unique(q.astype(np.uint16) * 256 + r, return_inverse=True)
+    results = [ parasail.nw_trace_striped_32(chr(p // 256), chr(p % 256), 10, 1, parasail.dnafull) for p in pairs.tolist() ]
+    return results, pair_index.ravel()
 
-            offset = 0
-            if q_gaps > 0 or r_gaps > 0:
-                # append a single base to the start
-                q_sub = query_aligned[i-1] + q_sub.replace("-", "")
-                r_sub = reference_aligned[i-1] + r_sub.replace("-", "")
-                offset = 1
+# the ungapped alignment of two equal length genomes, with the comparison string
+# taken from parasail for every distinct pair of characters
+def get_alignment_ungapped(reference_genome, input_genome, pairs=None):
+    results, pair_index = pairs or ungapped_pairs(reference_genome, input_genome)
+    symbols = [ result.traceback.comp for result in results ]
+    comparison = np.frombuffer("".join(symbols).encode('ascii'), dtype=np.uint8)[pair_index]
+    return reference_genome.sequence, comparison.tobytes().decode('ascii'), input_genome.sequence
 
-            # Record the difference
-            print("%s\t%d\t.\t%s\t%s\t.\t." % (reference_name, reference_position - offset + 1, r_sub.upper(), q_sub.upper()))
+# True if, in the window around each run of differences, the ungapped alignment
+# scores as well as the best gapped alignment of the window
+def is_ungapped_optimal(reference_genome, input_genome, pairs, margin=OPTIMALITY_MARGIN):
+    results, pair_index = pairs
+    scores = np.array([ result.score for result in results ], dtype=np.int64)[pair_index]
+    reference = reference_genome.sequence
+    query = input_genome.sequence
 
-            # update counters
-            reference_position += (j - i - r_gaps)
-            query_position += (j - i - q_gaps)
-            i = j
+    # windows reaching margin bases either side of each run, merged where they overlap
+    starts, ends = true_runs(as_array(reference.upper()) != as_array(query.upper()))
+    if len(starts) == 0:
+        return True
+    window_starts = np.maximum(starts - margin, 0)
+    window_ends = np.minimum(ends + margin, len(reference))
+    breaks = np.flatnonzero(window_starts[1:] > window_ends[:-1]) + 1
+    window_starts = window_starts[np.concatenate(([0], breaks))].tolist()
+    window_ends = window_ends[np.concatenate((breaks - 1, [len(ends) - 1]))].tolist()
 
+    for i, j in zip(window_starts, window_ends):
+        best = parasail.nw_striped_32(query[i:j], reference[i:j], 10, 1, parasail.dnafull)
+        if int(scores[i:j].sum()) != best.score:
+            return False
+    return True
+
+# align two genomes, using the ungapped comparison when it's optimal, otherwise
+# an anchored or full alignment
+def align_genomes(reference_genome, input_genome, anchored=False, reference_profile=None):
+    if is_substitution_only(reference_genome, input_genome):
+        pairs = ungapped_pairs(reference_genome, input_genome)
+        if is_ungapped_optimal(reference_genome, input_genome, pairs):
+            return get_alignment_ungapped(reference_genome, input_genome, pairs)
+    if anchored:
+        return get_alignment_anchored(reference_genome, input_genome)
+    return get_alignment_parasail(reference_genome, input_genome, reference_profile)
+
+def alignment2vcf(reference_name, reference_aligned, query_aligned, out=sys.stdout):
+
+    lines = [ "##fileformat=VCFv4.2\n", "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\n" ]
+
+    # find the runs of differing columns, and the number of reference bases before every column
+    reference_array = as_array(reference_aligned)
+    starts, ends = true_runs(reference_array != as_array(query_aligned))
+    reference_positions = np.concatenate(([0], np.cumsum(reference_array != ord("-"))))
+
+    for i, j in zip(starts.tolist(), ends.tolist()):
+        # Get difference strings
+        q_sub = query_aligned[i:j]
+        r_sub = reference_aligned[i:j]
+
+        offset = 0
+        if "-" in q_sub or "-" in r_sub:
+            # append a single base to the start
+            q_sub = query_aligned[i-1] + q_sub.replace("-", "")
+            r_sub = reference_aligned[i-1] + r_sub.replace("-", "")
+            offset = 1
+
+        # Record the difference
+        lines.append("%s\t%d\t.\t%s\t%s\t.\t.\n" % (reference_name, reference_positions[i] - offset + 1, r_sub.upper(), q_sub.upper()))
+
+    out.write("".join(lines))
+
+
+# per-process cache of reference genome and profile by filename, so that each
+# worker in --batch/--manifest mode reads and profiles a reference only once
+reference_cache = dict()
+batch_anchored = False
+
+def init_batch_worker(anchored):
+    global batch_anchored
+    batch_anchored = anchored
+
+def load_reference(reference_filename):
+    if reference_filename not in reference_cache:
+        reference_genome = get_sequence(file=reference_filename)
+        reference_profile = None if batch_anchored else make_reference_profile(reference_genome)
+        reference_cache[reference_filename] = (reference_genome, reference_profile)
+    return reference_cache[reference_filename]
+
+# align one genome (a Genome, or a fasta file name) to its reference and write
+# the differences as a VCF, for --batch/--manifest mode
+def align_batch_job(job):
+    genome, reference_filename, vcf_filename = job
+    reference_genome, reference_profile = load_reference(reference_filename)
+    input_genome = genome if isinstance(genome, Genome) else get_sequence(file=genome)
+    (reference_aligned, comparison_aligned, query_aligned) = align_genomes(reference_genome, input_genome, batch_anchored, reference_profile)
+    with open(vcf_filename, 'w') as out:
+        alignment2vcf(reference_genome.name, reference_aligned, query_aligned, out)
+
+# jobs aligning every genome of a multi-fasta to one reference, written to <output_dir>/<name>.vcf
+def read_batch_fasta(fasta_filename, reference_filename, output_dir):
+    return [ (record.name, (Genome(record.name, record.sequence), reference_filename, os.path.join(output_dir, record.name + ".vcf")))
+             for record in pysam.FastxFile(fasta_filename) ]
+
+# jobs from a tab-separated manifest with columns sample, genome, reference and vcf
+def read_manifest(manifest_filename):
+    jobs = list()
+    with open(manifest_filename) as fh:
+        for row in csv.DictReader(fh, delimiter='\t'):
+            for column in [ "sample", "genome", "reference", "vcf" ]:
+                if not row.get(column):
+                    raise RuntimeError(f"{manifest_filename}: missing {column} for row {row}")
+            jobs.append((row["sample"], (row["genome"], row["reference"], row["vcf"])))
+    return jobs
 
 def main():
     """
@@ -79,15 +317,39 @@ def main():
     parser.add_argument('-g', '--genome', help='consensus genome FASTA file to process')
     parser.add_argument('-r', '--reference-genome', help='fasta file containing the reference genome')
     parser.add_argument('-o', '--output-mode', default="differences")
+    parser.add_argument('-a', '--anchored', action='store_true',
+                        help='only align the windows between exact k-mer anchors, rather than the full genomes')
+
+    parser.add_argument('-b', '--batch',
+                        help='multi-FASTA of consensus genomes to align to the reference genome, writing <output-dir>/<name>.vcf for each')
+    parser.add_argument('-m', '--manifest',
+                        help='tab-separated file with columns sample, genome, reference and vcf, aligning each genome to its reference')
+    parser.add_argument('-d', '--output-dir', default=".",
+                        help='output directory for the VCFs in --batch mode')
+    parser.add_argument('-t', '--threads', type=int, default=1,
+                        help='number of genomes to align at once in --batch/--manifest mode. Without --anchored each '
+                             'alignment holds a full traceback matrix, so memory grows with this')
 
     if len(sys.argv) <= 1:
         parser.print_help(sys.stderr)
         sys.exit(1)
     args = parser.parse_args()
 
+    if args.batch or args.manifest:
+        if args.batch and args.manifest:
+            parser.error("--batch and --manifest cannot be used together")
+        if args.batch:
+            if not args.reference_genome:
+                parser.error("--batch requires --reference-genome")
+            os.makedirs(args.output_dir, exist_ok=True)
+            jobs = read_batch_fasta(args.batch, args.reference_genome, args.output_dir)
+        else:
+            jobs = read_manifest(args.manifest)
+        sys.exit(run_batch(align_batch_job, jobs, args.threads, "Aligned", init_batch_worker, (args.anchored,)))
+
     reference_genome = get_sequence(file=args.reference_genome)
     input_genome = get_sequence(file=args.genome)
-    (reference_aligned, comparison_aligned, query_aligned) = get_alignment_parasail(reference_genome, input_genome)
+    (reference_aligned, comparison_aligned, query_aligned) = align_genomes(reference_genome, input_genome, args.anchored)
 
     if args.output_mode == "differences":
         columns = 120
@@ -1,18 +1,27 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import re
 import sys
 import glob
 import json
+import pickle
+import sqlite3
+import hashlib
 import zipfile
+import argparse
+import functools
 import contextlib
 import html.parser
+import multiprocessing
 
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from depth_io import read_depth
+
 long_git_id = '$Id: b158164f87c79271ddc9d1083e64e4be1fc26d8e $'
 
 assert long_git_id.startswith('$Id: ')
@@ -65,47 +74,81 @@ def read_file(filename, allow_missing=True, zname=None):
                 for line in f:
                     yield line.decode('ascii')
 
-class QUASTParser(html.parser.HTMLParser):
+def simplify_quast_report(data):
+    """
+    Converts the 'report' part of the QUAST total-report-json (a list of [group_name, metrics] pairs)
+    to a dict (metric_name) -> (metric_value), since each report has only one sample.
+    """
 
-    def __init__(self):
-        html.parser.HTMLParser.__init__(self)
-        self.extracting = False
-        self.quast_data = ""
+    simplified_report = {}
+    for report_group in data:
+        if report_group[1] != []:
+            for metric in report_group[1]:
+                metric_name = metric['metricName'].strip()
+                metric_value = metric['values'][0]
 
+                if metric_name in simplified_report:
+                    print(f"{metric_name} collision in report")
+                else:
+                    simplified_report[metric_name] = metric_value
+    return simplified_report
 
-    def handle_starttag(self, tag, attr):
-        if tag == 'div' and attr == [('id', 'total-report-json')]:
-            self.extracting = True
-        else:
-            return
 
-    def handle_data(self, data):
-        if self.extracting == True:
-            self.quast_data += data
+def extract_quast_json(html_filename):
+    """
+    Returns the JSON payload of the <div id="total-report-json"> element in a QUAST report.html,
+    or None if there is no such element. The report is a few hundred KB of embedded javascript,
+    so rather than tokenizing it with html.parser, the raw bytes are searched for the div.
+    """
+
+    with open(html_filename, 'rb') as f:
+        report = f.read()
+
+    m = re.search(rb'<div\s+id=["\']total-report-json["\']\s*>', report, re.IGNORECASE)
+    if m is None:
+        return None
+
+    end = report.find(b'</div>', m.end())
+    if end < 0:
+        end = len(report)
+
+    payload = report[m.end():end].decode('utf-8')
+    if '&' in payload:
+        payload = html.unescape(payload)
+
+    return json.loads(payload.strip())
 
-    def handle_endtag(self, tag):
-        if tag == 'div' and self.extracting == True:
-            self.extracting = False
 
-    def convert_data_to_json(self):
-        # convert to json and then simplify as each report has only one sample
-        data = json.loads(self.quast_data.strip())
+def quast_tsv_filenames(html_filename):
+    """
+    QUAST's own tab-separated reports, next to {sn}_quast_report.html. The Snakefile renames
+    report.tsv to {sn}_quast_report.tsv, but not transposed_report.tsv.
+    """
+
+    dirname = os.path.dirname(html_filename)
+    return [ html_filename[:-len('.html')] + '.tsv', os.path.join(dirname, 'transposed_report.tsv') ]
 
-        data = data['report']
 
-        # simplify report by creating metric: metric_value pairs
-        simplified_report = {}
-        for report_group in data:
-            if report_group[1] != []:
-                for metric in report_group[1]:
-                    metric_name = metric['metricName'].strip()
-                    metric_value = metric['values'][0]
+def read_quast_tsv(html_filename):
+    """
+    Returns dict (metric_name) -> (metric_value) from QUAST's report.tsv or transposed_report.tsv,
+    or None if neither exists. Values are strings, and metrics reported as '-' are omitted.
+    """
+
+    (report_tsv, transposed_tsv) = quast_tsv_filenames(html_filename)
+
+    if os.path.exists(report_tsv):
+        with open(report_tsv) as f:
+            rows = [ line.rstrip('\r\n').split('\t') for line in f if line.strip() ]
+        pairs = [ (row[0], row[1]) for row in rows[1:] if len(row) >= 2 ]
+    elif os.path.exists(transposed_tsv):
+        with open(transposed_tsv) as f:
+            rows = [ line.rstrip('\r\n').split('\t') for line in f if line.strip() ]
+        pairs = list(zip(rows[0][1:], rows[1][1:])) if (len(rows) >= 2) else [ ]
+    else:
+        return None
 
-                    if metric_name in simplified_report:
-                        print(f"{metric_name} collision in report")
-                    else:
-                        simplified_report[metric_name] = metric_value
-        return simplified_report
+    return { name.strip(): value.strip() for (name, value) in pairs if value.strip() not in ['', '-'] }
 
 
 class TextFileParser:
@@ -116,14 +159,22 @@ class TextFileParser:
 
     def __init__(self):
         self._field_names = [ ]
-        self._field_details = [ ]  # List of 4-tuples (regexp_pattern, regexp_group, dtype, required)
+        self._field_details = [ ]  # List of 6-tuples (regexp, regexp_group, dtype, required, reducer, prefilter)
+
+    def add_field(self, field_name, regexp_pattern, regexp_group=1, dtype=str, required=True, reducer=None, prefilter=None):
+        """
+        The regexp is matched at the start of each line. As an optimization, the regexp is only
+        tried on lines which start with its leading literal text (if any), and contain the
+        'prefilter' string (if specified), which must be a substring of every matching line.
+        """
 
-    def add_field(self, field_name, regexp_pattern, regexp_group=1, dtype=str, required=True, reducer=None):
         assert field_name not in self._field_names
+        regexp = re.compile(regexp_pattern)
+        prefilter = (literal_prefix(regexp_pattern), prefilter)
         self._field_names.append(field_name)
-        self._field_details.append((regexp_pattern, regexp_group, dtype, required, reducer))
+        self._field_details.append((regexp, regexp_group, dtype, required, reducer, prefilter))
 
-    def parse_file(self, filename, allow_missing=True, zname=None):
+    def parse_file(self, filename, allow_missing=True, zname=None, stop_early=False):
         """
         Parses the specified file and returns a dict (field_name) -> (parsed_value).
 
@@ -136,21 +187,37 @@ class TextFileParser:
         If a regexp fails to match, then either an exception is thrown, or the
         corresponding parsed_value is set to None, depending on whether 'required'
         was True when add_field() was called.
+
+        If stop_early=True, and no field has a reducer, then reading stops as soon as
+        every field has been parsed (so a field which appears twice is not detected).
         """
 
         if file_is_missing(filename, allow_missing):
             return { name: None for name in self._field_names }
 
         ret = { name: [] for name in self._field_names }
+        fields = [ (ret[name],) + details for (name, details) in zip(self._field_names, self._field_details) ]
+        stop_early = stop_early and all((reducer is None) for (_,_,_,_,reducer,_) in self._field_details)
+        nfound = 0
+
+        lines = read_file(filename, allow_missing, zname)
 
-        for line in read_file(filename, allow_missing, zname):
-            for (name, (regexp_pattern, regexp_group, dtype, _, _)) in zip(self._field_names, self._field_details):
-                m = re.match(regexp_pattern, line)
+        for line in lines:
+            for (vals, regexp, regexp_group, dtype, _, _, (prefix, prefilter)) in fields:
+                if not line.startswith(prefix):
+                    continue
+                if (prefilter is not None) and (prefilter not in line):
+                    continue
+                m = regexp.match(line)
                 if m is not None:
-                    val = dtype(m.group(regexp_group))
-                    ret[name].append(val)
+                    vals.append(dtype(m.group(regexp_group)))
+                    nfound += (len(vals) == 1)
+            if stop_early and (nfound == len(fields)):
+                break
+
+        lines.close()
 
-        for (name, (_,_,_,required,reducer)) in zip(self._field_names, self._field_details):
+        for (name, (_,_,_,required,reducer,_)) in zip(self._field_names, self._field_details):
             if required and len(ret[name]) == 0:
                 raise RuntimeError(f"{filename}: failed to parse field '{name}'")
             if reducer is not None:
@@ -165,6 +232,36 @@ class TextFileParser:
         return ret
 
 
+def literal_prefix(regexp_pattern):
+    """
+    Returns the literal text which every match of 'regexp_pattern' (with re.match) starts with,
+    e.g. 'Total Sequences' for the pattern 'Total Sequences\\s+(\\d+)'.
+    Conservative: stops at the first character which isn't unambiguously literal.
+    """
+
+    if '|' in regexp_pattern:
+        return ''   # a top-level alternation could match without the prefix
+
+    prefix = ''
+    i = 0
+
+    while i < len(regexp_pattern):
+        c = regexp_pattern[i]
+        if c in '.^$*+?{}[]|()':
+            break
+        if c == '\\':
+            if (i+1 >= len(regexp_pattern)) or regexp_pattern[i+1].isalnum():
+                break  # character class such as \s or \d, or a backreference
+            c = regexp_pattern[i+1]
+            i += 1
+        i += 1
+        if (i < len(regexp_pattern)) and (regexp_pattern[i] in '*?{'):
+            break  # the last character is optional
+        prefix += c
+
+    return prefix
+
+
 def comma_separated_int(s):
     """
     Used as the 'dtype' argument to TextFileParser.add_field(), to parse integer fields
@@ -278,9 +375,130 @@ def xround(x, ndigits):
     return round(x,ndigits) if (x is not None) else None
 
 
+#######################    Persistent cache for parsed pipeline output files   #####################
+
+
+class ParseCache:
+    """
+    Persistent cache of the values returned by the parse_*() functions, stored in an
+    SQLite database in the toplevel pipeline directory, so that rerunning the
+    postprocessing after a few samples have changed only parses the changed files.
+
+    Each entry is identified by the function name and its arguments, and holds the value
+    for one 'version' of its inputs: the (path, size, mtime) of each input file, and a hash
+    of this script and the helper modules used by the parsers (so that a changed parser
+    invalidates its entries). A new version replaces the previous entry, so the database
+    doesn't grow as inputs change. New entries are only collected in self.pending, and
+    written by flush() in the parent process, so that worker processes never write to it.
+    """
+
+    source_hash = None
+
+    def __init__(self, filename, rebuild=False):
+        self.filename = filename
+        self.pending = [ ]
+        self.db = None
+        self.db_pid = None
+
+        if rebuild and os.path.exists(filename):
+            os.remove(filename)
+
+        if ParseCache.source_hash is None:
+            # this script, and depth_io.py which parse_coverage() reads depth files with
+            h = hashlib.sha1()
+            for source_filename in [ __file__, sys.modules[read_depth.__module__].__file__ ]:
+                with open(source_filename, 'rb') as f:
+                    h.update(f.read())
+            ParseCache.source_hash = h.hexdigest()
+
+    def connect(self):
+        # An sqlite3 connection can't be shared with a forked child process, so each process opens its own.
+        if self.db_pid != os.getpid():
+            self.db = sqlite3.connect(self.filename)
+            self.db.execute('CREATE TABLE IF NOT EXISTS parse_results (name TEXT PRIMARY KEY, version TEXT, value BLOB)')
+            self.db_pid = os.getpid()
+        return self.db
+
+    def make_key(self, func_name, filenames, kwargs):
+        """Returns (name, version), see class docstring."""
+
+        files = [ ]
+        for filename in filenames:
+            try:
+                st = os.stat(filename)
+                files.append([st.st_size, st.st_mtime_ns])
+            except FileNotFoundError:
+                files.append([None, None])
+
+        name = json.dumps([ func_name, list(filenames), sorted(kwargs.items()) ])
+        version = json.dumps([ self.source_hash, files ])
+        return (name, version)
+
+    def get(self, key):
+        """Returns (value, output) or None, where 'output' is everything the parse function printed."""
+
+        row = self.connect().execute('SELECT value FROM parse_results WHERE name = ? AND version = ?', key).fetchone()
+        return pickle.loads(row[0]) if (row is not None) else None
+
+    def put(self, key, value, output):
+        # Pickled now, since Sample.__init__() modifies some of the parsed dicts in place.
+        self.pending.append(key + (pickle.dumps((value, output)),))
+
+    def flush(self, entries=None):
+        entries = self.pending if (entries is None) else entries
+        if len(entries) > 0:
+            db = self.connect()
+            db.executemany('INSERT OR REPLACE INTO parse_results VALUES (?, ?, ?)', entries)
+            db.commit()
+        if entries is self.pending:
+            self.pending = [ ]
+
+
+# Set by Pipeline (and in each worker process by init_worker()), None if caching is disabled.
+parse_cache = None
+
+
+def cached_parse(f=None, extra_inputs=None):
+    """
+    Decorator for parse_*() functions whose positional arguments are input filenames.
+    If parse_cache is enabled, an unchanged set of input files is served from the cache,
+    and warnings printed by the parse function (e.g. for missing files) are replayed.
+
+    If the function also reads other files, use @cached_parse(extra_inputs=g), where
+    g(*args) returns a list of their filenames, so that they're part of the cache key.
+    """
+
+    if f is None:
+        return functools.partial(cached_parse, extra_inputs=extra_inputs)
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if parse_cache is None:
+            return f(*args, **kwargs)
+
+        filenames = list(args) + (extra_inputs(*args) if (extra_inputs is not None) else [ ])
+        key = parse_cache.make_key(f.__name__, filenames, kwargs)
+        hit = parse_cache.get(key)
+
+        if hit is not None:
+            (value, output) = hit
+            print(output, end='')
+            return value
+
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            value = f(*args, **kwargs)
+
+        print(out.getvalue(), end='')
+        parse_cache.put(key, value, out.getvalue())
+        return value
+
+    return wrapper
+
+
 ########################    Parsing functions for pipeline output files   ##########################
 
 
+@cached_parse
 def parse_trim_galore_log(filename, allow_missing=True):
     """Returns dict (field_name) -> (parsed_value), see code for list of field_names."""
 
@@ -304,7 +522,7 @@ def parse_fastqc_output(zip_filename, allow_missing=True):
     t.add_field('total_sequences', r'Total Sequences\s+(\d+)', dtype=int)
     t.add_field('flagged_sequences', r'Sequences flagged as poor quality\s+(\d+)', dtype=int)
 
-    ret = t.parse_file(zip_filename, allow_missing, zname_data)
+    ret = t.parse_file(zip_filename, allow_missing, zname_data, stop_early=True)
     ret['summary'] = { }   # dict (text -> flavor) pairs, where flavor is in ['PASS','WARN','FAIL']
 
     for line in read_file(zip_filename, allow_missing, zname_summ):
@@ -316,6 +534,7 @@ def parse_fastqc_output(zip_filename, allow_missing=True):
     return ret
 
 
+@cached_parse
 def parse_fastqc_pair(zip_filename1, zip_filename2, allow_missing=True):
     """Returns dict (field_name) -> (parsed_value), see code for list of field_names."""
 
@@ -349,11 +568,13 @@ def parse_fastqc_pair(zip_filename1, zip_filename2, allow_missing=True):
              'summary': summary }
 
 
+@cached_parse
 def parse_kraken2_report(report_filename, allow_missing=True):
     """Returns dict (field_name) -> (parsed_value), see code for list of field_names."""
 
     t = TextFileParser()
-    t.add_field('sars_cov2_percentage', r'\s*([\d\.]*)\s+.*Severe acute respiratory syndrome coronavirus 2', dtype=float)
+    t.add_field('sars_cov2_percentage', r'\s*([\d\.]*)\s+.*Severe acute respiratory syndrome coronavirus 2', dtype=float,
+                prefilter='Severe acute respiratory syndrome coronavirus 2')
     try:
         t_dict = t.parse_file(report_filename, allow_missing)
     except RuntimeError:
@@ -373,21 +594,20 @@ def parse_hostremove_hisat2_log(log_filename, allow_missing=True):
     return t.parse_file(log_filename, allow_missing)
 
 
+@cached_parse(extra_inputs=quast_tsv_filenames)
 def parse_quast_report(report_filename, allow_missing=True):
     """Returns dict (field_name) -> (parsed_value), see code for list of field_names."""
 
-    # unfortunately only the quast report html contains all the fields
-    # need for summaries, fortunately, it is all encoded in easily extractable
-    # json
-    q = QUASTParser()
-    try:
-        with open(report_filename) as fh:
-            report = fh.read()
-        q.feed(report)
-        quast_report = q.convert_data_to_json()
-    except FileNotFoundError:
+    # the quast report html contains all the fields needed for summaries,
+    # encoded in easily extractable json. If the html is missing (or has no
+    # json), fall back to quast's tab-separated report.
+    quast_json = extract_quast_json(report_filename) if os.path.exists(report_filename) else None
+    quast_report = simplify_quast_report(quast_json['report']) if (quast_json is not None) else read_quast_tsv(report_filename)
+
+    if quast_report is None:
+        if os.path.exists(report_filename):
+            raise RuntimeError(f"{report_filename}: total-report-json not found")
         print("Warning: file %s does not exist" %(report_filename))
-        report = None
         quast_report ={'Total length (>= 0 bp)': 0, "# N's per 100 kbp": 0}
 
 
@@ -395,12 +615,14 @@ def parse_quast_report(report_filename, allow_missing=True):
     ret['genome_length'] = float(quast_report['Total length (>= 0 bp)'])
     ret['Ns_per_100_kbp'] = float(quast_report["# N's per 100 kbp"])
 
-    # if genome fails to align to reference these all fail thus the try/except
+    # if genome fails to align to reference these all fail thus the try/except.
+    # The absolute mismatch and indel counts are only in the html report, so they
+    # are missing data rather than a failure when reading quast's report.tsv
     try:
         ret['genomic_features'] = str(quast_report['# genomic features'])
-        ret['mismatches'] = float(quast_report['# mismatches'])
+        ret['mismatches'] = float(quast_report['# mismatches']) if (quast_json is not None) else None
         ret['mismatches_per_100_kbp'] = float(quast_report['# mismatches per 100 kbp'])
-        ret['indels'] = float(quast_report['# indels'])
+        ret['indels'] = float(quast_report['# indels']) if (quast_json is not None) else None
         ret['indels_per_100_kbp'] = float(quast_report['# indels per 100 kbp'])
         ret['genome_fraction'] = float(quast_report['Genome fraction (%)'])
     except KeyError:
@@ -415,7 +637,7 @@ def parse_quast_report(report_filename, allow_missing=True):
     ret['qc_gfrac'] = "PASS" if ((gfrac is not None) and (gfrac >= 90)) else "FAIL"
 
     # to add a failure mode if the reference fails to align
-    indels = ret['indels']
+    indels = ret['indels'] if (ret['indels'] is not None) else ret['indels_per_100_kbp']
     if indels == 0:
         ret['qc_indel'] = "PASS"
     elif type(indels) == float:
@@ -427,6 +649,7 @@ def parse_quast_report(report_filename, allow_missing=True):
 
     return ret
 
+@cached_parse
 def parse_consensus_assembly(fasta_filename, allow_missing=True):
     """Returns dict (field_name) -> (parsed_value), see code for list of field_names."""
 
@@ -457,6 +680,7 @@ def parse_consensus_assembly(fasta_filename, allow_missing=True):
     return { 'N5prime': prime5, 'N3prime': prime3 }
 
 
+@cached_parse
 def parse_coverage(depth_filename, allow_missing=True):
     """Returns dict (field_name) -> (parsed_value), see code for list of field_names."""
 
@@ -479,13 +703,7 @@ def parse_coverage(depth_filename, allow_missing=True):
     if file_is_missing(depth_filename, allow_missing):
         return ret
 
-    coverage = []
-    for line in open(depth_filename):
-        t = line.split('\t')
-        assert len(t) == 3
-        coverage.append(int(float(t[2].strip("\n"))))
-
-    coverage = np.array(coverage)
+    coverage = read_depth(depth_filename)
     bin_assignments = np.searchsorted(np.array(delims), coverage, side='left')
     bin_fractions = np.bincount(bin_assignments, minlength=nbins) / float(len(coverage))
     assert bin_fractions.shape == (nbins,)
@@ -553,6 +771,7 @@ def parse_lmat_output(lmat_dirname, allow_missing=True):
     return { 'top_taxa': top_taxa, 'top_taxa_ann': top_taxa_ann }
 
 
+@cached_parse
 def parse_ivar_variants(tsv_filename, allow_missing=True):
     """Returns dict (field_name) -> (parsed_value), see code for list of field_names."""
 
@@ -571,6 +790,7 @@ def parse_ivar_variants(tsv_filename, allow_missing=True):
 
     return { 'variants': variants }
 
+@cached_parse
 def parse_freebayes_variants(vcf_filename, allow_missing=True):
     """Returns dict (field_name) -> (parsed_value), see code for list of field_names."""
 
@@ -590,6 +810,7 @@ def parse_freebayes_variants(vcf_filename, allow_missing=True):
 
     return { 'variants': variants, 'run': True }
 
+@cached_parse
 def parse_consensus_compare(vcf_filename, allow_missing=True):
     """Returns dict (field_name) -> (parsed_value), see code for list of field_names."""
 
@@ -653,35 +874,232 @@ def parse_lineage(tsv_filename, sample_names, allow_missing=True):
     assert len(samples) == len(sample_names)
     return { 'samples': samples }
 
-def parse_breseq_output(html_filename, allow_missing=True):
-    """Returns dict (field_name) -> (parsed_value), see code for list of field_names."""
+# Positional fields of the GenomeDiff mutation and evidence types, after (type, id, parent_ids).
+# Anything after these is a key=value field.
+genome_diff_fields = {
+    'SNP': [ 'seq_id', 'position', 'new_seq' ],
+    'SUB': [ 'seq_id', 'position', 'size', 'new_seq' ],
+    'DEL': [ 'seq_id', 'position', 'size' ],
+    'INS': [ 'seq_id', 'position', 'new_seq' ],
+    'MOB': [ 'seq_id', 'position', 'repeat_name', 'strand', 'duplication_size' ],
+    'AMP': [ 'seq_id', 'position', 'size', 'new_copy_number' ],
+    'CON': [ 'seq_id', 'position', 'size', 'region' ],
+    'INV': [ 'seq_id', 'position', 'size' ],
+    'RA': [ 'seq_id', 'position', 'insert_position', 'ref_base', 'new_base' ],
+    'MC': [ 'seq_id', 'start', 'end', 'start_range', 'end_range' ],
+    'JC': [ 'side_1_seq_id', 'side_1_position', 'side_1_strand', 'side_2_seq_id', 'side_2_position', 'side_2_strand', 'overlap' ],
+    'UN': [ 'seq_id', 'start', 'end' ],
+}
+
+genome_diff_mutation_types = [ 'SNP', 'SUB', 'DEL', 'INS', 'MOB', 'AMP', 'CON', 'INV' ]
+
+# Inserted sequences longer than this are shown as '+N bp' in the breseq mutation table.
+breseq_max_inserted_seq = 20
+
+
+def read_genome_diff(gd_filename):
+    """
+    Generator which reads a breseq GenomeDiff file (e.g. output.gd) line by line, and yields
+    dicts with keys 'type', 'id', 'parents' (list of evidence ids), plus the positional and
+    key=value fields of the entry as strings. Entries of unknown type only have key=value fields.
+    """
 
-    if file_is_missing(html_filename, allow_missing):
-        return { 'variants': [], 'qc_varfreq': 'MISSING', 'qc_orf_frameshift': 'MISSING', 'run': False}
+    with open(gd_filename) as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if (len(line) == 0) or line.startswith('#'):
+                continue
+
+            t = line.split('\t')
+            assert len(t) >= 3, f"{gd_filename}: bad GenomeDiff line '{line}'"
+
+            entry = { 'type': t[0], 'id': t[1], 'parents': [ x for x in t[2].split(',') if x != '.' ] }
+            names = genome_diff_fields.get(t[0], [ ])
+
+            for (i, x) in enumerate(t[3:]):
+                if (i < len(names)) and ('=' not in x):
+                    entry[names[i]] = x
+                elif '=' in x:
+                    (k, v) = x.split('=', 1)
+                    entry[k] = v
+
+            yield entry
+
+
+def html_cell_text(s):
+    """
+    Returns the text of an HTML table cell containing 's', as SimpleHTMLTableParser would
+    parse it (the text between tags, with entities converted, joined by spaces).
+    """
+
+    return ' '.join(html.unescape(x) for x in re.split(r'<[^>]*>', s) if x != '')
+
+
+def breseq_gene_html(mut):
+    """Gene cell of the breseq mutation table, e.g. '<i>S</i>&nbsp;&rarr;', from gene_name and gene_strand."""
+
+    if 'html_gene_name' in mut:
+        return mut['html_gene_name']
+
+    names = mut.get('gene_name', '').split('/')
+    strands = mut.get('gene_strand', '').split('/')
+    arrows = { '>': '&rarr;', '<': '&larr;' }
+
+    if len(names) != len(strands):
+        return f"<i>{mut.get('gene_name', '')}</i>"
+
+    # For an intergenic mutation, the arrow of the gene on the left comes after its name.
+    cells = [ ]
+    for (i, (name, strand)) in enumerate(zip(names, strands)):
+        name = name if (name in [ '', '–', '-' ]) else f'<i>{name}</i>'
+        if strand not in arrows:
+            cells.append(name)
+        elif (i == 0) and (len(names) > 1):
+            cells.append(f'{name}&nbsp;{arrows[strand]}')
+        else:
+            cells.append(f'{arrows[strand]}&nbsp;{name}' if (len(names) > 1) else f'{name}&nbsp;{arrows[strand]}')
 
-    tables = parse_html_tables(html_filename)
+    return '&nbsp;/&nbsp;'.join(cells)
 
-    assert len(tables) >= 2
-    assert tables[1][0] in [ ['Predicted mutation'], ['Predicted mutations'] ]
-    assert tables[1][1] == [ 'evidence', 'position', 'mutation', 'freq', 'annotation', 'gene', 'description']
 
-    for t in tables[2:]:
-        assert t[0] in [ ['Unassigned missing coverage evidence'], ['Unassigned new junction evidence'] ]
+def breseq_mutation_html(mut, evidence):
+    """Mutation cell of the breseq mutation table, e.g. 'A&rarr;G', '&Delta;22 bp' or '+TTT'."""
+
+    if 'html_mutation' in mut:
+        return mut['html_mutation']
+
+    t = mut['type']
+
+    if ('repeat_seq' in mut) and (t in [ 'INS', 'DEL' ]):
+        return f"({mut['repeat_seq']})<sub>{mut['repeat_ref_copies']}&rarr;{mut['repeat_new_copies']}</sub>"
+    if t == 'SNP':
+        ref = mut.get('ref_seq')
+        if ref is None:
+            ref = next((e['ref_base'] for e in evidence if (e['type'] == 'RA') and ('ref_base' in e)), '?')
+        return f"{ref}&rarr;{mut['new_seq']}"
+    if t == 'DEL':
+        return f"&Delta;{int(mut['size']):,} bp"
+    if t == 'INS':
+        new_seq = mut['new_seq']
+        return f"+{new_seq}" if (len(new_seq) <= breseq_max_inserted_seq) else f"+{len(new_seq):,} bp"
+    if t == 'SUB':
+        return f"{int(mut['size']):,} bp&rarr;{mut['new_seq']}"
+    if t == 'MOB':
+        strand = { '1': '+', '-1': '-' }.get(mut['strand'], mut['strand'])
+        return f"{mut['repeat_name']} ({strand}) +{mut['duplication_size']} bp"
+    if t == 'AMP':
+        return f"{int(mut['size']):,} bp x {mut['new_copy_number']}"
+    if t == 'CON':
+        return f"{int(mut['size']):,} bp&rarr;{mut['region']}"
+    if t == 'INV':
+        return f"{int(mut['size']):,} bp inversion"
+
+    raise RuntimeError(f"unexpected GenomeDiff mutation type '{t}'")
+
+
+def breseq_annotation_html(mut):
+    """Annotation cell of the breseq mutation table, e.g. 'D614G (GAT&rarr;GGT)' or 'coding (123/456 nt)'."""
+
+    if 'html_mutation_annotation' in mut:
+        return mut['html_mutation_annotation']
+
+    if mut.get('snp_type') in [ 'nonsynonymous', 'synonymous', 'nonsense' ]:
+        return f"{mut['aa_ref_seq']}{mut['aa_position']}{mut['aa_new_seq']} ({mut['codon_ref_seq']}&rarr;{mut['codon_new_seq']})"
+
+    return mut.get('gene_position', '')
+
+
+def read_breseq_genome_diff(gd_filename):
+    """
+    Returns the rows of the 'Predicted mutations' table in breseq's index.html, reconstructed
+    from evidence/annotated.gd, as 7-tuples (evidence, position, mutation, freq, annotation, gene,
+    description) of strings, in the same form as parse_html_tables() returns them.
+
+    Returns None if a mutation has no gene annotation (as in output.gd), since the annotation
+    and the frameshift check that depends on it could not be reconstructed.
+    """
+
+    mutations = [ ]
+    evidence = { }   # id -> entry, for the evidence referenced by the mutations
+
+    for entry in read_genome_diff(gd_filename):
+        if entry['type'] in genome_diff_mutation_types:
+            mutations.append(entry)
+        elif len(entry['type']) == 2:
+            evidence[entry['id']] = entry
+
+    rows = [ ]
+
+    if any((('gene_name' not in mut) and ('html_gene_name' not in mut)) for mut in mutations):
+        return None
+
+    for mut in mutations:
+        mut_evidence = [ evidence[i] for i in mut['parents'] if i in evidence ]
+
+        # One link per evidence type, e.g. '<a href="...">MC</a> <a href="...">JC</a>' in index.html
+        evi = html_cell_text(' '.join(f'<a>{t}</a>' for t in dict.fromkeys(e['type'] for e in mut_evidence)))
+        pos = f"{int(mut['position']):,}"
+        freq = float(mut.get('frequency', 1))
+        freq = '100%' if (freq == 1) else f"{100*freq:.1f}%"
+
+        mut_html = breseq_mutation_html(mut, mut_evidence)
+        ann_html = breseq_annotation_html(mut)
+        gene_html = breseq_gene_html(mut)
+        desc_html = mut.get('html_gene_product', mut.get('gene_product', ''))
+
+        rows.append((evi, pos, html_cell_text(mut_html), freq, html_cell_text(ann_html),
+                     html_cell_text(gene_html), html_cell_text(desc_html)))
+
+    return rows
+
+
+def breseq_output_filenames(html_filename):
+    """Files read by parse_breseq_output(), in addition to index.html."""
+
+    return [ os.path.join(os.path.dirname(html_filename), 'evidence', 'annotated.gd') ]
+
+
+@cached_parse(extra_inputs=breseq_output_filenames)
+def parse_breseq_output(html_filename, allow_missing=True, genome_diff=False):
+    """
+    Returns dict (field_name) -> (parsed_value), see code for list of field_names.
+
+    The predicted mutations are parsed from the mutation table in breseq's index.html. If
+    genome_diff=True, they're read from evidence/annotated.gd (GenomeDiff) instead, when it
+    exists and every mutation in it is annotated.
+    """
+
+    (gd_filename,) = breseq_output_filenames(html_filename)
+    rows = read_breseq_genome_diff(gd_filename) if (genome_diff and os.path.exists(gd_filename)) else None
+
+    if rows is None:
+        if file_is_missing(html_filename, allow_missing):
+            return { 'variants': [], 'qc_varfreq': 'MISSING', 'qc_orf_frameshift': 'MISSING', 'run': False}
+
+        tables = parse_html_tables(html_filename)
+
+        assert len(tables) >= 2
+        assert tables[1][0] in [ ['Predicted mutation'], ['Predicted mutations'] ]
+        assert tables[1][1] == [ 'evidence', 'position', 'mutation', 'freq', 'annotation', 'gene', 'description']
+
+        for t in tables[2:]:
+            assert t[0] in [ ['Unassigned missing coverage evidence'], ['Unassigned new junction evidence'] ]
+
+        rows = tables[1][2:]
 
     variants = [ ]
     qc_varfreq = 'PASS'
     qc_orf_frameshift = 'PASS'
 
-    for row in tables[1][2:]:
+    for row in rows:
         assert len(row) == 7
         (evi, pos, mut, freq, ann, gene, desc) = row
 
         assert freq.endswith('%')
         freq = freq[:-1]
 
-        # TODO: improve breseq html parsing
-        # Currently, the "annotation" is unreadable.
-        # The "description" is sometimes readable and sometimes not (e.g. it can contain embedded javascript!)
+        # The "description" is sometimes readable and sometimes not in index.html
+        # (e.g. it can contain embedded javascript!), and isn't used.
 
         # Ad hoc improvement of html parsing for 'gene', may need revisiting
         gene = gene.replace('\xa0','')       # remove cosmetic html '&nbsp;'
@@ -1305,7 +1723,7 @@ class Archive:
 class Sample:
     """Must be constructed from toplevel pipeline directory."""
 
-    def __init__(self, name, ivarlin, fblin):
+    def __init__(self, name, ivarlin, fblin, breseq_genome_diff=False):
         self.name = name
 
         self.trim_galore = parse_trim_galore_log(f"{name}/adapter_trimmed/{name}_trim_galore.log")
@@ -1319,7 +1737,7 @@ class Sample:
         self.ivar = parse_ivar_variants(f"{name}/core/{name}_ivar_variants.tsv")
         self.freebayes = parse_freebayes_variants(f"{name}/freebayes/{name}.variants.norm.vcf")
         self.compare = parse_consensus_compare(f"{name}/freebayes/{name}_consensus_compare.vcf")
-        self.breseq = parse_breseq_output(f"{name}/breseq/{name}_output/index.html")
+        self.breseq = parse_breseq_output(f"{name}/breseq/{name}_output/index.html", genome_diff=breseq_genome_diff)
 
 
         if ivarlin['lineage'] != fblin['lineage'] and fblin['lineage'] is not None:
@@ -1375,17 +1793,61 @@ class Sample:
                 self.consensus[itemvar] = str(self.consensus[itemvar]) + "*"
 
 
+def make_sample(args):
+    """
+    Worker for Pipeline(..., threads > 1). Constructs one Sample, capturing everything
+    it prints (e.g. warnings for missing files), so that the caller can print it in
+    sample order and the output matches a serial run.
+    """
+
+    with contextlib.redirect_stdout(io.StringIO()) as f:
+        sample = Sample(*args)
+
+    # New parse cache entries are returned to the caller, which writes them to the database.
+    entries = [ ]
+    if parse_cache is not None:
+        (entries, parse_cache.pending) = (parse_cache.pending, [ ])
+
+    return (sample, f.getvalue(), entries)
+
+
+def init_worker(cache_filename):
+    """Pool initializer for Pipeline(..., threads > 1), opens the parse cache in each worker."""
+
+    global parse_cache
+    parse_cache = ParseCache(cache_filename) if (cache_filename is not None) else None
+
+
 class Pipeline:
     """Must be constructed from toplevel pipeline directory."""
 
-    def __init__(self, sample_csv_filename):
+    def __init__(self, sample_csv_filename, threads=1, cache_filename=None, rebuild_cache=False, breseq_genome_diff=False):
+        global parse_cache
+        parse_cache = ParseCache(cache_filename, rebuild_cache) if (cache_filename is not None) else None
+
         sample_csv = pd.read_csv(sample_csv_filename)
         sample_names = sorted(sample_csv['sample'].drop_duplicates().values)
 
         self.iv_lineage = parse_lineage(f"lineage_assignments.tsv", sample_names)
         self.fb_lineage = parse_lineage(f"freebayes_lineage_assignments.tsv", sample_names)
 
-        self.samples = [ Sample(s, self.iv_lineage['samples'][s], self.fb_lineage['samples'][s]) for s in sample_names ]
+        args = [ (s, self.iv_lineage['samples'][s], self.fb_lineage['samples'][s], breseq_genome_diff) for s in sample_names ]
+
+        if threads > 1:
+            # Samples are independent, so they're constructed in a pool of worker processes.
+            # Pool.imap() returns them in order, and their output is printed in the same order.
+            self.samples = [ ]
+            with multiprocessing.Pool(threads, initializer=init_worker, initargs=(cache_filename,)) as pool:
+                for (sample, output, entries) in pool.imap(make_sample, args):
+                    print(output, end='')
+                    self.samples.append(sample)
+                    if parse_cache is not None:
+                        parse_cache.flush(entries)
+        else:
+            self.samples = [ Sample(*a) for a in args ]
+
+        if parse_cache is not None:
+            parse_cache.flush()
 
         if len(self.samples) == 0:
             raise RuntimeError(f"{sample_csv_filename} contains zero samples, nothing to do!")
@@ -1552,12 +2014,17 @@ class Pipeline:
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print(f"Usage: c19_postprocess.py <sample_table.csv>", file=sys.stderr)
-        print(f"Note: must be run from toplevel pipeline directory", file=sys.stderr)
-        sys.exit(1)
-
-    p = Pipeline(sys.argv[1])
+    parser = argparse.ArgumentParser(description='Summarize pipeline results (must be run from toplevel pipeline directory)')
+    parser.add_argument('sample_table', help='sample table (csv)')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='number of samples to parse at once')
+    parser.add_argument('--cache', default='postprocess_cache.sqlite', help='cache of parsed output files, reused for unchanged files (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true', help='parse every output file, without reading or writing the cache')
+    parser.add_argument('--rebuild-cache', action='store_true', help='discard the cache and parse every output file again')
+    parser.add_argument('--breseq-genome-diff', action='store_true', help="read breseq's predicted mutations from evidence/annotated.gd rather than index.html")
+    args = parser.parse_args()
+
+    cache_filename = None if args.no_cache else args.cache
+    p = Pipeline(args.sample_table, args.threads, cache_filename, args.rebuild_cache, args.breseq_genome_diff)
     p.write_summary_plot1()
     p.write_summary_plot2()
     p.write_summary_plot3()